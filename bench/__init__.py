@@ -0,0 +1,4 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2023 Nikita Travkin <nikita@trvn.ru>
+
+"""Offline benchmarks of c5, see 'python3 -m bench --help'"""
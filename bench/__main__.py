@@ -0,0 +1,107 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2023 Nikita Travkin <nikita@trvn.ru>
+
+"""Benchmark c5 without a kernel tree or cross toolchain.
+
+The 'e2e' benchmark runs 'c5 test' on a synthetic kernel-shaped repo with
+stub make, checkpatch and tools from bench/stubs, and reports the time per
+span category from the trace. The 'diff' benchmark times the detection of
+new warnings on multi-MiB logs.
+"""
+
+import argparse
+import collections
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+TOP = os.path.dirname(BENCH)
+
+def run_e2e(cmdargs, workdir):
+    import bench.fixture
+
+    tree = os.path.join(workdir, "linux")
+    base = bench.fixture.make_tree(tree, vendors=cmdargs.vendors, boards=cmdargs.boards)
+    bench.fixture.make_series(tree, commits=cmdargs.commits, vendors=cmdargs.vendors, boards=cmdargs.boards)
+
+    env = dict(os.environ)
+    env["PATH"] = os.path.join(BENCH, "stubs") + os.pathsep + env["PATH"]
+    env["XDG_CACHE_HOME"] = os.path.join(workdir, "cache")
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [TOP, os.path.join(TOP, "c5"), env.get("PYTHONPATH")]))
+    env["C5_BENCH_DTB_WARNINGS"] = str(cmdargs.warnings)
+    env["C5_BENCH_DELAY"] = str(cmdargs.delay)
+
+    print(f"{'run':<8} {'wall s':>8}  top categories")
+    for run in range(cmdargs.runs):
+        trace = os.path.join(workdir, f"trace-{run}.json")
+        args = [sys.executable, os.path.join(TOP, "c5", "command.py"), "test",
+                "--base", base, "-j", str(cmdargs.jobs), "--trace", trace]
+        if not cmdargs.cache:
+            args.append("--no-cache")
+
+        start = time.perf_counter()
+        ret = subprocess.run(args, cwd=tree, env=env, stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE, text=True, check=False)
+        elapsed = time.perf_counter() - start
+        if ret.returncode != 0:
+            print(ret.stderr, file=sys.stderr)
+            raise RuntimeError("c5 test failed")
+
+        with open(trace, "r") as file:
+            events = json.load(file)["traceEvents"]
+
+        cats = collections.Counter()
+        for event in events:
+            cats[event["cat"]] += event["dur"] / 1000000
+
+        top = ", ".join(f"{cat} {dur:.2f}" for cat, dur in cats.most_common(5))
+        print(f"{run:<8} {elapsed:>8.2f}  {top}")
+
+def run_diff(cmdargs):
+    import bench.diff
+    bench.diff.report(bench.diff.run([int(mib * (1 << 20)) for mib in cmdargs.log_mib], cmdargs.fuzzy))
+
+def main():
+    parser = argparse.ArgumentParser(prog="python3 -m bench", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", choices=["e2e", "diff"], default=None,
+                        help="Run only one of the benchmarks")
+    parser.add_argument("--workdir", default=None,
+                        help="Where to create the synthetic tree (default: a temporary dir)")
+
+    group = parser.add_argument_group("e2e")
+    group.add_argument("--commits", type=int, default=9, help="Commits in the series")
+    group.add_argument("--vendors", type=int, default=4, help="dts vendor dirs in the tree")
+    group.add_argument("--boards", type=int, default=20, help="Boards per vendor")
+    group.add_argument("--warnings", type=int, default=50, help="dtbs_check warnings per dtb")
+    group.add_argument("--delay", type=float, default=0.0, help="Seconds of stub make work per target")
+    group.add_argument("--jobs", type=int, default=1, help="c5 test -j")
+    group.add_argument("--runs", type=int, default=2, help="Times to run c5 test, later runs can hit the cache")
+    group.add_argument("--no-cache", dest="cache", action="store_false", help="Run c5 test with --no-cache")
+
+    group = parser.add_argument_group("diff")
+    group.add_argument("--log-mib", type=float, nargs="+", default=[0.5, 2, 8],
+                       help="Sizes of the synthetic logs")
+    group.add_argument("--fuzzy", type=float, default=0.98, help="Similarity of a known warning")
+
+    cmdargs = parser.parse_args()
+
+    sys.path[:0] = [TOP, os.path.join(TOP, "c5")]
+
+    if cmdargs.only in (None, "diff"):
+        run_diff(cmdargs)
+
+    if cmdargs.only in (None, "e2e"):
+        if cmdargs.workdir is not None:
+            os.makedirs(cmdargs.workdir, exist_ok=True)
+            run_e2e(cmdargs, cmdargs.workdir)
+        else:
+            with tempfile.TemporaryDirectory(prefix="c5-bench-") as workdir:
+                run_e2e(cmdargs, workdir)
+
+if __name__ == "__main__":
+    main()
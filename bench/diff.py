@@ -0,0 +1,69 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2023 Nikita Travkin <nikita@trvn.ru>
+
+"""Micro-benchmarks of the new warning detection on synthetic logs"""
+
+import random
+import time
+
+import c5
+
+def make_log(size, seed=0):
+    """Return a dtbs_check-like log of about size bytes"""
+    rnd = random.Random(seed)
+    lines = []
+    total = 0
+    while total < size:
+        vendor = f"vendor{rnd.randrange(8)}"
+        line = (f"/src/linux/.c5-out/build-0/arm64/arch/arm64/boot/dts/{vendor}/{vendor}-board{rnd.randrange(40)}.dtb: "
+                f"soc@0/node@{rnd.randrange(1 << 16):x}: compatible: ['{vendor},thing-{rnd.randrange(97)}'] "
+                f"is too short\n")
+        lines.append(line)
+        total += len(line)
+
+    return "".join(lines)
+
+def mutate_log(old, changed=0.01, seed=1):
+    """Return the log with a fraction of the lines built elsewhere or entirely changed, and shuffled"""
+    rnd = random.Random(seed)
+    lines = old.splitlines(keepends=True)
+    for i in rnd.sample(range(len(lines)), int(len(lines) * changed)):
+        if rnd.random() < 0.5:
+            # Built in another worktree, still the same warning
+            lines[i] = lines[i].replace("/build-0/", "/build-1/")
+        else:
+            lines[i] = f"arch/arm64/boot/dts/new.dts:{i}: Warning (unit_address_vs_reg): new warning {i}\n"
+
+    rnd.shuffle(lines)
+    return "".join(lines)
+
+def _measure(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+def run(sizes, fuzzy=0.98):
+    """Time get_new_lines() and the streaming NewLines on logs of the given sizes (bytes)"""
+    rows = []
+    for size in sizes:
+        old = make_log(size)
+        new = mutate_log(old)
+
+        elapsed, found = _measure(lambda: c5.get_new_lines(old, new, fuzzy))
+        rows.append(("get_new_lines", size, len(new.splitlines()), elapsed, len(found.splitlines())))
+
+        def stream():
+            newlines = c5.NewLines(old, fuzzy)
+            for line in new.splitlines(keepends=True):
+                newlines(line, True)
+            return newlines.text()
+
+        elapsed, found = _measure(stream)
+        rows.append(("NewLines", size, len(new.splitlines()), elapsed, len(found.splitlines())))
+
+    return rows
+
+def report(rows):
+    print(f"{'':<16} {'MiB':>6} {'lines':>8} {'s':>8} {'lines/s':>9} {'new':>6}")
+    for name, size, lines, elapsed, found in rows:
+        print(f"{name:<16} {size / (1 << 20):>6.1f} {lines:>8} {elapsed:>8.2f} {lines / elapsed:>9.0f} {found:>6}")
@@ -0,0 +1,100 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2023 Nikita Travkin <nikita@trvn.ru>
+
+"""A small git repo shaped like a kernel tree, with a patch series on top"""
+
+import os
+import random
+import shutil
+import subprocess
+
+STUBS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stubs")
+
+def _git(path, *args):
+    subprocess.run(["git", "-C", path] + list(args), check=True, capture_output=True)
+
+def _write(path, name, text):
+    filename = os.path.join(path, name)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, "w") as file:
+        file.write(text)
+
+def _commit(path, message):
+    _git(path, "add", "-A")
+    _git(path, "commit", "-q", "-m", message)
+
+def make_tree(path, vendors=4, boards=20, drivers=20):
+    """Create the base tree, return the base commit"""
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+    _git(path, "init", "-q")
+    _git(path, "config", "user.name", "c5 bench")
+    _git(path, "config", "user.email", "bench@c5")
+
+    _write(path, ".gitignore", "/.c5-out/\n")
+    _write(path, "Makefile", "# The stub make does not read this\n")
+    _write(path, "Kconfig", "source \"arch/arm64/Kconfig\"\nsource \"drivers/Kconfig\"\n")
+    _write(path, "arch/arm64/Kconfig", "config ARM64\n\tdef_bool y\n" +
+           "".join(f"config ARCH_VENDOR{v}\n\tbool \"vendor{v}\"\n" for v in range(vendors)))
+    _write(path, "drivers/Kconfig", "".join(f"source \"drivers/vendor{v}/Kconfig\"\n" for v in range(vendors)))
+    _write(path, "drivers/Makefile", "".join(f"obj-$(CONFIG_VENDOR{v}) += vendor{v}/\n" for v in range(vendors)))
+    os.makedirs(os.path.join(path, "scripts"))
+    shutil.copy(os.path.join(STUBS, "checkpatch.pl"), os.path.join(path, "scripts/checkpatch.pl"))
+
+    os.makedirs(os.path.join(path, "scripts/dtc/include-prefixes"))
+    os.symlink("../../../arch/arm64/boot/dts", os.path.join(path, "scripts/dtc/include-prefixes/arm64"))
+    os.symlink("../../../include/dt-bindings", os.path.join(path, "scripts/dtc/include-prefixes/dt-bindings"))
+
+    for v in range(vendors):
+        vendor = f"vendor{v}"
+        _write(path, f"include/dt-bindings/clock/{vendor}.h", f"#define {vendor.upper()}_CLK 1\n")
+        _write(path, f"arch/arm64/boot/dts/{vendor}/soc.dtsi",
+               f"#include <dt-bindings/clock/{vendor}.h>\n/ {{\n\tsoc@0 {{ }};\n}};\n")
+
+        makefile = ""
+        for b in range(boards):
+            board = f"{vendor}-board{b}"
+            _write(path, f"arch/arm64/boot/dts/{vendor}/{board}.dts",
+                   f"/dts-v1/;\n#include \"soc.dtsi\"\n/ {{\n\tmodel = \"{board}\";\n}};\n")
+            makefile += f"dtb-$(CONFIG_ARCH_{vendor.upper()}) += {board}.dtb\n"
+        _write(path, f"arch/arm64/boot/dts/{vendor}/Makefile", makefile)
+
+        _write(path, f"Documentation/devicetree/bindings/{vendor}/thing.yaml",
+               f"$id: http://devicetree.org/schemas/{vendor}/thing.yaml#\ntitle: {vendor} thing\n")
+
+        kconfig = f"config VENDOR{v}\n\tbool \"{vendor} drivers\"\n"
+        makefile = ""
+        for d in range(drivers):
+            body = "".join(f"int {vendor}_fn{d}_{i}(void) {{ return {i}; }}\n" for i in range(50))
+            _write(path, f"drivers/{vendor}/driver{d}.c", body)
+            kconfig += f"config VENDOR{v}_DRIVER{d}\n\ttristate \"driver{d}\"\n\tdepends on VENDOR{v} || COMPILE_TEST\n"
+            makefile += f"obj-$(CONFIG_VENDOR{v}_DRIVER{d}) += driver{d}.o\n"
+        _write(path, f"drivers/{vendor}/Kconfig", kconfig)
+        _write(path, f"drivers/{vendor}/Makefile", makefile)
+
+    _commit(path, "Initial tree")
+    return subprocess.run(["git", "-C", path, "rev-parse", "HEAD"], check=True,
+                          capture_output=True, text=True).stdout.strip()
+
+def make_series(path, commits=10, vendors=4, boards=20, drivers=20, seed=0):
+    """Add a series of commits touching drivers, dts and bindings"""
+    rnd = random.Random(seed)
+    for i in range(commits):
+        vendor = f"vendor{rnd.randrange(vendors)}"
+        kind = ("driver", "dts", "binding")[i % 3]
+        if kind == "driver":
+            name = f"drivers/{vendor}/driver{rnd.randrange(drivers)}.c"
+            with open(os.path.join(path, name), "a") as file:
+                file.write(f"int {vendor}_patch{i}(void) {{ return {i}; }}\n")
+        elif kind == "dts":
+            name = f"arch/arm64/boot/dts/{vendor}/{vendor}-board{rnd.randrange(boards)}.dts"
+            with open(os.path.join(path, name), "a") as file:
+                file.write(f"&soc {{ status = \"okay\"; /* {i} */ }};\n")
+        else:
+            name = f"Documentation/devicetree/bindings/{vendor}/thing.yaml"
+            with open(os.path.join(path, name), "a") as file:
+                file.write(f"# revision {i}\n")
+
+        _commit(path, f"{vendor}: {kind}: change {i}")
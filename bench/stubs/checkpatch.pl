@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# Stand-in for scripts/checkpatch.pl --git, warns about every changed file.
+
+import subprocess
+import sys
+
+def git(*args):
+    return subprocess.run(["git"] + list(args), capture_output=True, check=True, text=True).stdout
+
+def main():
+    args = sys.argv[1:]
+    rev = args[args.index("--git") + 1]
+    terse = "--terse" in args
+
+    if ".." in rev:
+        commits = git("rev-list", "--reverse", rev).split()
+    else:
+        commits = [ git("rev-parse", rev).strip() ]
+
+    found = False
+    for commit in commits:
+        if len(commits) > 1 and not terse:
+            name = f"Commit {commit[:12]} (\"{git('log', '-1', '--format=%s', commit).strip()}\")"
+            print("-" * len(name))
+            print(name)
+            print("-" * len(name))
+
+        for path in git("diff-tree", "--no-commit-id", "--name-only", "-r", commit).split():
+            if path.endswith(".c"):
+                found = True
+                print(f"{path}:1: WARNING: Missing a blank line after declarations")
+                if not terse:
+                    print(f"#1: FILE: {path}:1:\n+int x;\n")
+
+    sys.exit(1 if found else 0)
+
+if __name__ == "__main__":
+    main()
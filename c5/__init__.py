@@ -1,61 +1,299 @@
 # SPDX-License-Identifier: GPL-2.0-only
 # Copyright (c) 2022 Nikita Travkin <nikita@trvn.ru>
 
+import bisect
+import collections
+import functools
+import hashlib
 import logging
 import os
 import subprocess
 import difflib
-import multiprocessing
+import queue
+import threading
+import time
+from contextlib import contextmanager
 
-import b4
-import b4.ez
-import b4.ty
+import c5.timing
 
 logger = logging.getLogger('c5')
 color = True
+live = False
+
+# Overrides used when testing in a separate worktree
+builddir = None
+cores = None
+
+# Cross compiler prefixes of the arches we can build for
+CROSS_COMPILE = {
+    "arm": "arm-linux-gnueabihf-",
+    "arm64": "aarch64-linux-gnu-",
+    "loongarch": "loongarch64-linux-gnu-",
+    "mips": "mips-linux-gnu-",
+    "powerpc": "powerpc64le-linux-gnu-",
+    "riscv": "riscv64-linux-gnu-",
+    "s390": "s390x-linux-gnu-",
+    "x86": "x86_64-linux-gnu-",
+}
+
+# Built when no changed file is arch-specific
+DEFAULT_ARCH = "arm64"
+
+# Arches to build for, None to pick them by the changed files
+arches = None
+
+_captures = {}
+
+def _capture_filter(record):
+    records = _captures.get(threading.get_ident())
+    if records is None:
+        return True
+
+    # Make the record safe to pass to another process
+    record.msg = record.getMessage()
+    record.args = None
+    records.append(record)
+    return False
+
+logger.addFilter(_capture_filter)
+
+@contextmanager
+def capture_log():
+    """Collect log records of the current thread instead of printing them"""
+    records = []
+    _captures[threading.get_ident()] = records
+    try:
+        yield records
+    finally:
+        del _captures[threading.get_ident()]
+
+def replay_log(records):
+    """Print the log records collected by capture_log()"""
+    for record in records:
+        logger.handle(record)
 
 def git_find_base_commit():
     """Return the commit id before the first change to test"""
+    import b4.ez
     series_start = b4.ez.get_series_start()
     return series_start
 
 def git_get_commit_subject(commit):
     """Return the subject line of the commit"""
+    import b4.ty
     _, out = b4.ty.git_get_commit_message(None, commit)
     return out.splitlines()[0]
 
 def git_get_changed_files(commit):
     """Return a list of files changed by the commit"""
+    import b4
     gitargs = ["diff-tree", "--no-commit-id", "--name-only", commit, "-r"]
     lines = b4.git_get_command_lines(None, gitargs)
     return lines
 
+@functools.lru_cache(maxsize=None)
+def git_get_patch_id(commit):
+    """Return the stable patch-id of the commit"""
+    ecode, out, _ = run_command(["git", "show", commit])
+    if ecode != 0:
+        raise RuntimeError()
+
+    ecode, out, _ = run_command(["git", "patch-id", "--stable"], stdin=out)
+    if ecode != 0:
+        raise RuntimeError()
+
+    return out.decode().split(" ", 1)[0]
+
+class CommitInfo:
+    """What is known about a commit of the series"""
+
+    def __init__(self, commit, subject):
+        self.commit = commit
+        self.subject = subject
+        self.message = None
+        self.tree = None
+        self.parent = None
+        self.parent_tree = None
+        self.files = {} # path -> status letter, in git order
+        self.patch_id = None
+
+class SeriesIndex:
+    """Subjects, messages, trees, changed files and patch-ids of the commits after the base,
+       from one git pass
+    """
+
+    def __init__(self, base_commit, tip="HEAD"):
+        self.base = base_commit
+        self.commits = []
+        self._by_commit = {}
+
+        gitargs = ["git", "log", "--reverse", "--no-renames", "--no-abbrev", "--raw", "-p",
+                   "--format=commit %H%ntree %T %P%n%s%n%w(0,4,4)%B%w(0,0,0)%x00", f"{base_commit}..{tip}"]
+        ecode, out, _ = run_command(gitargs)
+        if ecode != 0:
+            raise RuntimeError()
+
+        info = None
+        lines = iter(out.decode(errors="replace").split("\n"))
+        for line in lines:
+            if line.startswith("commit "):
+                commit = line[len("commit "):]
+                tree, parent = (next(lines).split()[1:] + [None])[:2]
+                info = CommitInfo(commit, next(lines))
+                info.tree = tree
+                info.parent = parent
+
+                # The message is indented and the tree named, so that patch-id doesn't take them for headers
+                message = []
+                for line in lines:
+                    if line == "\0":
+                        break
+                    message.append(line.removeprefix("    "))
+                info.message = "\n".join(message)
+
+                self.commits.append(info)
+                self._by_commit[info.commit] = info
+            elif line.startswith(":") and info is not None:
+                # :<mode> <mode> <blob> <blob> <status>\t<path>
+                meta, path = line.split("\t", 1)
+                info.files[path] = meta.split()[-1][0]
+
+        # patch-id only looks at the commit headers and the diffs
+        ecode, out, _ = run_command(["git", "patch-id", "--stable"], stdin=out)
+        if ecode != 0:
+            raise RuntimeError()
+
+        for line in out.decode().splitlines():
+            patch_id, commit = line.split()
+            self._by_commit[commit].patch_id = patch_id
+
+        trees = { info.commit: info.tree for info in self.commits }
+        for info in self.commits:
+            if info.parent is not None:
+                info.parent_tree = trees.get(info.parent) or git_get_tree(info.parent)
 
-def run_command(cmdargs, stdin=None, rundir=None):
-    if rundir:
-        logger.debug('Changing dir to %s', rundir)
-        curdir = os.getcwd()
-        os.chdir(rundir)
+        logger.debug("Indexed %d commits after %s", len(self.commits), base_commit[:12])
+
+    def __getitem__(self, commit):
+        return self._by_commit[commit]
+
+    def __contains__(self, commit):
+        return commit in self._by_commit
+
+def git_get_tree(commit="HEAD"):
+    """Return the tree id of the commit"""
+    import b4
+    lines = b4.git_get_command_lines(None, ["rev-parse", f"{commit}^{{tree}}"])
+    if not lines:
+        raise RuntimeError()
+
+    return lines[0]
+
+
+def _span_of(cmdargs):
+    """Return the timing span name and category for the command"""
+    tool = os.path.basename(cmdargs[0])
+    if tool == "make":
+        targets = [ arg for arg in cmdargs[1:] if "=" not in arg and not arg.startswith("-") ]
+        return " ".join(["make"] + targets), "make"
+    if tool == "git":
+        return f"git {cmdargs[1]}", "git"
+
+    return tool, "cmd"
+
+def run_command(cmdargs, stdin=None, cwd=None, env=None):
+    if cwd:
+        logger.debug('Running %s in %s', ' '.join(cmdargs), cwd)
     else:
-        curdir = None
+        logger.debug('Running %s', ' '.join(cmdargs))
 
-    logger.debug('Running %s' % ' '.join(cmdargs))
-    sp = subprocess.Popen(cmdargs, stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
-    (output, error) = sp.communicate(input=stdin)
-    if curdir:
-        logger.debug('Changing back into %s', curdir)
-        os.chdir(curdir)
+    with c5.timing.span(*_span_of(cmdargs)):
+        sp = subprocess.Popen(cmdargs, stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE,
+                              cwd=cwd, env=env)
+        (output, error) = sp.communicate(input=stdin)
 
     return sp.returncode, output, error
 
 
-def linux_temp_builddir():
-    """create the builddir if needed and return the path"""
-    kernel_base = b4.git_get_toplevel()
-    if kernel_base is None:
+def _read_lines(stream, is_err, lines):
+    for line in stream:
+        lines.put((line.decode(errors="replace"), is_err))
+    lines.put(None)
+
+def run_command_stream(cmdargs, consumer=None, logname=None, cwd=None, env=None, pass_fds=()):
+    """Run a command, passing its output to consumer(line, is_err) line by line as it arrives.
+       stderr is also written to logname as it arrives, and all the output is shown if
+       live output is enabled. Returns the exit code.
+    """
+    logger.debug('Running %s', ' '.join(cmdargs))
+
+    with c5.timing.span(*_span_of(cmdargs)):
+        return _run_command_stream(cmdargs, consumer, logname, cwd, env, pass_fds)
+
+def _run_command_stream(cmdargs, consumer, logname, cwd, env, pass_fds):
+    sp = subprocess.Popen(cmdargs, stdout=subprocess.PIPE, stdin=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                          cwd=cwd, env=env, pass_fds=pass_fds)
+
+    lines = queue.Queue(maxsize=1024)
+    readers = [ threading.Thread(target=_read_lines, args=(sp.stdout, False, lines)),
+                threading.Thread(target=_read_lines, args=(sp.stderr, True, lines)) ]
+    for reader in readers:
+        reader.start()
+
+    logfile = open(logname, "w") if logname else None
+    running = len(readers)
+    try:
+        while running > 0:
+            item = lines.get()
+            if item is None:
+                running -= 1
+                continue
+
+            line, is_err = item
+            if live:
+                logger.info("%s", line.rstrip("\n"))
+            if logfile is not None and is_err:
+                logfile.write(line)
+            if consumer is not None:
+                consumer(line, is_err)
+    finally:
+        if logfile is not None:
+            logfile.close()
+
+        # Stopped early, the readers may be waiting for room in the queue
+        if running > 0:
+            sp.kill()
+            while running > 0:
+                if lines.get() is None:
+                    running -= 1
+            sp.wait()
+
+        for reader in readers:
+            reader.join()
+
+    return sp.wait()
+
+
+def linux_out_base():
+    """Return the c5 output dir of the main checkout, shared with all the worktrees"""
+    import b4
+    lines = b4.git_get_command_lines(None, ["rev-parse", "--git-common-dir"])
+    if not lines:
         raise RuntimeError()
 
-    tempdir = kernel_base + "/.c5-out/"
+    kernel_base = os.path.dirname(os.path.abspath(lines[0]))
+    return kernel_base + "/.c5-out/"
+
+def linux_out_dir():
+    """Return the dir for the build dirs and logs"""
+    if builddir is not None:
+        return builddir
+
+    return linux_out_base()
+
+def linux_temp_builddir(arch=DEFAULT_ARCH):
+    """create the builddir of the arch if needed and return the path"""
+    tempdir = f"{linux_out_dir()}{arch}/"
 
     if not os.path.exists(tempdir):
         logger.debug('Creating %s', tempdir)
@@ -65,55 +303,307 @@ def linux_temp_builddir():
 
 def core_count():
     """Get amount of useful cores to compile with, leaving some to the user"""
-    cnt = multiprocessing.cpu_count()
+    if cores is not None:
+        return cores
+
+    import c5.jobserver
+    cnt = c5.jobserver.available_cpus()
     if cnt > 4:
         return cnt - 2
     else:
-        return cnt - 1
+        return max(1, cnt - 1)
 
-# FIXME: this assumes aarch64
-def linux_make(makeargs, archenvs=["CROSS_COMPILE=aarch64-linux-gnu-", "ARCH=arm64"]):
-    """Run make in the current kernel dir"""
-    tempdir = linux_temp_builddir()
-    cmdargs = ["make", f"-j{core_count()}", f"KBUILD_OUTPUT={tempdir}"] + archenvs + makeargs
+def arch_of(path):
+    """Return the arch of an arch-specific file, or None"""
+    parts = path.split("/", 2)
+    if len(parts) == 3 and parts[0] == "arch" and parts[1] in CROSS_COMPILE:
+        return parts[1]
 
-    return run_command(cmdargs)
+    return None
+
+def arches_for(files):
+    """Return the arches to build the files for: the ones asked for, or the arches
+       of the arch-specific files, or the default one.
+    """
+    if arches:
+        return list(arches)
+
+    found = sorted(set(arch_of(file) for file in files) - {None})
+    if len(found) == 0:
+        return [DEFAULT_ARCH]
+
+    return found
+
+def arch_envs(arch):
+    """Return the make variables to build for the arch"""
+    return [f"CROSS_COMPILE={CROSS_COMPILE[arch]}", f"ARCH={arch}"]
+
+def for_each_arch(func, archlist):
+    """Call func(arch) for all the arches at once, each one builds in its own dir.
+       Returns the results and prints the logs in the order of the arches.
+    """
+    if len(archlist) == 1:
+        return [func(archlist[0])]
+
+    slots = [ {"records": [], "result": None, "error": None} for _ in archlist ]
+
+    def worker(arch, slot):
+        with capture_log() as records:
+            slot["records"] = records
+            try:
+                slot["result"] = func(arch)
+            except Exception as ex: # Re-raised in the calling thread
+                slot["error"] = ex
+
+    threads = [ threading.Thread(target=worker, args=(arch, slot)) for arch, slot in zip(archlist, slots) ]
+    for thread in threads:
+        thread.start()
+
+    error = None
+    for thread, slot in zip(threads, slots):
+        thread.join()
+        replay_log(slot["records"])
+        if error is None:
+            error = slot["error"]
+
+    if error is not None:
+        raise error
+
+    return [ slot["result"] for slot in slots ]
+
+def linux_make(makeargs, arch=DEFAULT_ARCH, consumer=None, logname=None):
+    """Run make in the current kernel dir.
+       stdout is not kept. stderr is returned as text, unless a consumer is given
+       to process the output as it arrives, see run_command_stream().
+    """
+    import c5.ccache
+    import c5.jobserver
+    import c5.mtimes
+    tempdir = linux_temp_builddir(arch)
+    c5.mtimes.prepare(tempdir)
+    cmdargs = ["make", f"KBUILD_OUTPUT={tempdir}"] + arch_envs(arch) + c5.ccache.make_args(arch) + makeargs
+    env = dict(os.environ, **c5.ccache.env())
+
+    errlines = []
+    def collect(line, is_err):
+        if is_err:
+            errlines.append(line)
+
+    jobserver = c5.jobserver.current
+    if jobserver is None:
+        cmdargs.insert(1, f"-j{core_count()}")
+        if c5.jobserver.load_average is not None:
+            cmdargs.insert(2, f"-l{c5.jobserver.load_average}")
+        ecode = run_command_stream(cmdargs, consumer or collect, logname, env=env)
+    else:
+        # The makes share the slots, so the ones running together don't overload the CPUs
+        env["MAKEFLAGS"] = jobserver.makeflags()
+        with jobserver.token():
+            ecode = run_command_stream(cmdargs, consumer or collect, logname, env=env, pass_fds=jobserver.fds())
+
+    if consumer is not None:
+        return ecode, None, None
+
+    return ecode, None, "".join(errlines)
+
+@functools.lru_cache(maxsize=None)
+def tool_version(tool):
+    """Return the first line of 'tool --version', or an empty string if there is no such tool"""
+    try:
+        _, out, _ = run_command([tool, "--version"])
+    except FileNotFoundError:
+        return ""
+
+    return out.decode().split("\n", 1)[0]
+
+def linux_config_fingerprint(target, arch, fragment=None):
+    """Hash all the inputs that affect the generated .config"""
+    import b4
+    fingerprint = hashlib.sha256()
+    fingerprint.update(target.encode())
+    fingerprint.update((fragment or "").encode())
+    fingerprint.update(" ".join(arch_envs(arch)).encode())
+    fingerprint.update(tool_version(f"{CROSS_COMPILE[arch]}gcc").encode())
+
+    gitargs = ["ls-files", "--stage", "--", ":(glob)**/Kconfig*", "scripts/kconfig/"]
+    for line in b4.git_get_command_lines(None, gitargs):
+        fingerprint.update(line.encode())
+
+    return fingerprint.hexdigest()
+
+def linux_config(target="allyesconfig", arch=DEFAULT_ARCH, fragment=None):
+    """Generate the .config unless it's already generated from the same inputs.
+       The options in fragment are set before the target sets the others.
+    """
+    tempdir = linux_temp_builddir(arch)
+    stampfile = f"{tempdir}/.c5-config"
+    fingerprint = linux_config_fingerprint(target, arch, fragment)
+
+    if os.path.exists(f"{tempdir}/.config") and os.path.exists(stampfile):
+        with open(stampfile, "r") as stamp:
+            if stamp.read() == fingerprint:
+                logger.debug("Config cache hit, reusing %s", target)
+                return
+
+    logger.debug("Config cache miss, running %s", target)
+    if os.path.exists(stampfile):
+        os.remove(stampfile)
+
+    makeargs = [target]
+    if fragment is not None:
+        fragmentfile = f"{tempdir}.c5-fragment"
+        with open(fragmentfile, "w") as file:
+            file.write(fragment)
+        makeargs.append(f"KCONFIG_ALLCONFIG={fragmentfile}")
+
+    ecode, _, err = linux_make(makeargs, arch)
+    if ecode != 0:
+        logger.error("Failed to generate %s for %s!", target, arch)
+        logger.info("%s", err)
+        raise RuntimeError()
+
+    with open(stampfile, "w") as stamp:
+        stamp.write(fingerprint)
+
+def linux_config_id(arch=DEFAULT_ARCH):
+    """Return the fingerprint of the .config generated for the arch, None if there is none"""
+    try:
+        with open(f"{linux_temp_builddir(arch)}/.c5-config", "r") as stamp:
+            return stamp.read()
+    except FileNotFoundError:
+        return None
 
 def linux_logfile(name):
-    """Get a logfile path"""
-    tempdir = linux_temp_builddir()
-    return f"{tempdir}/log-{name}.txt"
+    """Get a path to write a log to, until it's moved to c5.logs"""
+    tempdir = linux_out_dir()
+    os.makedirs(tempdir, exist_ok=True)
+    return f"{tempdir}log-{name}.txt"
 
 
-def _fuzzy_cmp(newl, oldlines, fuzzy):
-    maxr = 0
-    for oldl in oldlines:
-        ratio = difflib.SequenceMatcher(None, oldl, newl).ratio()
-        maxr = max(maxr, ratio)
+def split_by_file(msg, files, pattern):
+    """Split a tool output into the messages about each of the files.
+       A line matching the pattern with one of the files in its 'file' group
+       starts the messages about that file, the following lines belong to it.
+       Lines before the first match are returned under the None key.
+       The paths are compared relative to the tree, make prints them with
+       the srctree prefix when building out of the tree.
+    """
+    import c5.parsers
+    ret = { file: [] for file in files }
+    ret[None] = []
+    current = None
 
-    if maxr < fuzzy:
-        return newl
+    for line in msg.splitlines(keepends=True):
+        match = pattern.search(line)
+        if match is not None:
+            path = c5.parsers.tree_path(match.group("file"))
+            if path in ret:
+                current = path
+        ret[current].append(line)
 
-    return None
+    return { file: "".join(lines) for file, lines in ret.items() }
 
-def get_new_lines(old, new, fuzzy=0.98):
-    oldlines = set(old.splitlines(keepends=True))
-    newlines = new.splitlines(keepends=True)
 
-    if len(oldlines) == 0:
-        return new
+class NewLines:
+    """Consumer for run_command_stream() collecting the stderr messages that
+       are not in the old output, like get_new_lines().
+    """
+
+    def __init__(self, old, fuzzy=0.98):
+        import c5.parsers
+        self.start = time.time()
+        startclock = time.perf_counter()
+        self.filter = c5.parsers.MessageFilter(old, fuzzy)
+        self.elapsed = time.perf_counter() - startclock
+
+    def __call__(self, line, is_err):
+        if not is_err:
+            return
+
+        startclock = time.perf_counter()
+        self.filter.feed(line)
+        self.elapsed += time.perf_counter() - startclock
+
+    def text(self):
+        startclock = time.perf_counter()
+        text = self.filter.text()
+        self.elapsed += time.perf_counter() - startclock
+
+        # The matching is spread over the build, record the total time
+        c5.timing.add("match new lines", "diff", self.start, self.elapsed)
+        return text.rstrip("\n")
 
-    tmp = []
-    for newl in newlines:
-        if newl not in oldlines:
-            tmp.append(newl)
 
-    with multiprocessing.Pool() as pool:
-        matches = pool.starmap(_fuzzy_cmp, map(lambda x: (x, oldlines, fuzzy), tmp))
+class LineMatcher:
+    """Index of old lines to quickly tell if a new line is similar to any of them.
 
-    ret = [ val for val in matches if val is not None ]
+       A line matches if SequenceMatcher ratio against some old line is at least
+       'fuzzy'. Candidates are looked up by the rarest q-grams of the new line:
+       a pair with ratio >= fuzzy differs in at most d = T * (1 - fuzzy) chars,
+       each of which can break at most Q q-grams, so the old line has to share
+       all but Q * d of the probed q-grams. Only the candidates are compared.
+    """
 
-    seen = set()
-    ret = [val for val in ret if not (val in seen or seen.add(val))]
+    Q = 4
+
+    def __init__(self, oldlines, fuzzy=0.98):
+        self.fuzzy = fuzzy
+        self.lines = sorted(set(oldlines), key=len)
+        self.exact = set(self.lines)
+        self.lengths = [ len(line) for line in self.lines ]
+        self.index = {}
+
+        for i, line in enumerate(self.lines):
+            for gram in set(self._qgrams(line)):
+                self.index.setdefault(gram, []).append(i)
+
+    def _qgrams(self, line):
+        return [ line[i:i + self.Q] for i in range(len(line) - self.Q + 1) ]
+
+    def _candidates(self, newl):
+        # Only lines of similar length can pass real_quick_ratio()
+        lo = bisect.bisect_left(self.lengths, len(newl) * self.fuzzy / (2 - self.fuzzy))
+        hi = bisect.bisect_right(self.lengths, len(newl) * (2 - self.fuzzy) / self.fuzzy)
+
+        grams = self._qgrams(newl)
+        maxdiff = int(2 * len(newl) / self.fuzzy * (1 - self.fuzzy)) + 1
+        if self.Q * maxdiff + 1 > len(grams):
+            return range(lo, hi)
+
+        # Look at the rarest q-grams, a match has to share all but
+        # Q * maxdiff of them.
+        grams.sort(key=lambda gram: len(self.index.get(gram, ())))
+        probe = min(2 * self.Q * maxdiff + 1, len(grams))
+        hits = collections.Counter()
+        for gram in grams[:probe]:
+            # Postings are sorted by line length too
+            posting = self.index.get(gram, [])
+            hits.update(posting[bisect.bisect_left(posting, lo):bisect.bisect_left(posting, hi)])
+
+        need = probe - self.Q * maxdiff
+        return [ i for i, cnt in hits.most_common() if cnt >= need ]
+
+    def matches(self, newl):
+        """Is the line similar enough to one of the old lines?"""
+        if newl in self.exact:
+            return True
+
+        sm = difflib.SequenceMatcher(None, "", newl)
+        for i in self._candidates(newl):
+            sm.set_seq1(self.lines[i])
+            if sm.real_quick_ratio() < self.fuzzy or sm.quick_ratio() < self.fuzzy:
+                continue
+            if sm.ratio() >= self.fuzzy:
+                return True
+
+        return False
+
+def get_new_lines(old, new, fuzzy=0.98):
+    """Return the messages in the new tool output that are not in the old one"""
+    import c5.parsers
+    with c5.timing.span("get_new_lines", "diff"):
+        messages = c5.parsers.MessageFilter(old, fuzzy)
+        for line in new.splitlines(keepends=True):
+            messages.feed(line)
 
-    return "".join(ret)
+        return messages.text()
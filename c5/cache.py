@@ -0,0 +1,130 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2023 Nikita Travkin <nikita@trvn.ru>
+
+#pylint: disable=missing-module-docstring
+
+import collections
+import hashlib
+import json
+import os
+import threading
+
+import c5
+
+logger = c5.logger
+
+enabled = True
+max_size = 64 * 1024 * 1024
+
+# Recently used values, so a long-running c5 doesn't read them again
+_memory = collections.OrderedDict()
+_memory_entries = 32
+_memory_lock = threading.Lock()
+
+def _remember(name, key, value):
+    with _memory_lock:
+        _memory[(name, key)] = value
+        _memory.move_to_end((name, key))
+        while len(_memory) > _memory_entries:
+            _memory.popitem(last=False)
+
+def cache_dir(name):
+    """Return the directory of the named cache, create it if needed"""
+    base = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    path = os.path.join(base, "c5", name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def make_key(*parts):
+    """Hash the json-serializable parts into a cache key"""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+def get(name, key):
+    """Return the cached value or None"""
+    if not enabled:
+        return None
+
+    with _memory_lock:
+        if (name, key) in _memory:
+            _memory.move_to_end((name, key))
+            return _memory[(name, key)]
+
+    path = os.path.join(cache_dir(name), f"{key}.json")
+    try:
+        with open(path, "r") as file:
+            value = json.load(file)
+    except (OSError, ValueError):
+        return None
+
+    # Mark as recently used for the eviction
+    os.utime(path)
+    _remember(name, key, value)
+    return value
+
+def put(name, key, value):
+    """Store the value, evicting the least recently used values above max_size"""
+    if not enabled:
+        return
+
+    path = os.path.join(cache_dir(name), f"{key}.json")
+    tmppath = f"{path}.{os.getpid()}.tmp"
+    with open(tmppath, "w") as file:
+        json.dump(value, file)
+    os.replace(tmppath, path)
+    _remember(name, key, value)
+
+    evict(name)
+
+def evict(name):
+    """Drop the least recently used values until the cache fits max_size"""
+    path = cache_dir(name)
+    entries = []
+    for entry in os.scandir(path):
+        if entry.name.endswith(".json"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(entry[1] for entry in entries)
+    for _, size, entrypath in sorted(entries):
+        if total <= max_size:
+            break
+
+        logger.debug("Evicting %s from the cache", entrypath)
+        try:
+            os.remove(entrypath)
+        except FileNotFoundError:
+            pass # Evicted by another c5
+        total -= size
+
+
+def get_baseline(key):
+    """Return the cached baseline warnings or None"""
+    value = get("baselines", key)
+    if value is None:
+        return None
+
+    return value["warnings"]
+
+def put_baseline(key, warnings):
+    """Store the baseline warnings"""
+    put("baselines", key, {"warnings": warnings})
+
+
+def get_result(key):
+    """Return the cached (TestResult, (phase, log digest) list) or None"""
+    value = get("results", key)
+    if value is None:
+        return None
+
+    import c5.testcases
+    result = getattr(c5.testcases, value["result"])(value["msg"])
+    return result, value.get("logs", [])
+
+def put_result(key, result, logs=()):
+    """Store the TestResult of a testcase and the logs saved by it"""
+    value = {
+        "result": type(result).__name__,
+        "msg": result.msg,
+        "logs": list(logs),
+    }
+    put("results", key, value)
@@ -0,0 +1,78 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2023 Nikita Travkin <nikita@trvn.ru>
+
+#pylint: disable=missing-module-docstring
+
+import functools
+import os
+import shutil
+
+import c5
+import c5.cache
+
+logger = c5.logger
+
+enabled = True
+max_size = "5G"
+
+@functools.lru_cache(maxsize=None)
+def available():
+    """Is ccache installed?"""
+    if shutil.which("ccache") is None:
+        logger.debug("ccache is not installed, building without it")
+        return False
+
+    return True
+
+def make_args(arch):
+    """Return the make variables to build for the arch through ccache"""
+    if not enabled or not available():
+        return []
+
+    return [f"CC=ccache {c5.CROSS_COMPILE[arch]}gcc", "HOSTCC=ccache gcc"]
+
+def env():
+    """Return the environment for ccache"""
+    if not enabled or not available():
+        return {}
+
+    return {
+        "CCACHE_DIR": c5.cache.cache_dir("ccache"),
+        "CCACHE_MAXSIZE": max_size,
+        # Hash the paths relative to the build dir, the main checkout holds the worktrees and build dirs
+        "CCACHE_BASEDIR": os.path.dirname(c5.linux_out_base().rstrip("/")),
+        "CCACHE_NOHASHDIR": "1",
+        # git touches the files, the content is what matters
+        "CCACHE_SLOPPINESS": "include_file_mtime,include_file_ctime,time_macros",
+    }
+
+def stats():
+    """Return the (hits, misses) counters of the cache, or None if unknown"""
+    if not enabled or not available():
+        return None
+
+    ecode, out, _ = c5.run_command(["ccache", "--print-stats"], env=dict(os.environ, **env()))
+    if ecode != 0:
+        return None # Only ccache 4 can print the stats
+
+    counters = {}
+    for line in out.decode().splitlines():
+        key, _, value = line.partition("\t")
+        if value.isdigit():
+            counters[key] = int(value)
+
+    hits = counters.get("direct_cache_hit", 0) + counters.get("preprocessed_cache_hit", 0)
+    return hits, counters.get("cache_miss", 0)
+
+def report(before):
+    """Log the hits and misses since the stats() were taken"""
+    after = stats()
+    if before is None or after is None:
+        return
+
+    hits = after[0] - before[0]
+    misses = after[1] - before[1]
+    if hits + misses == 0:
+        return
+
+    logger.info("ccache: %d hits, %d misses (%d%% hit rate)", hits, misses, 100 * hits // (hits + misses))
@@ -6,14 +6,53 @@ import logging
 import sys
 
 import c5
-import c5.test
 import c5.testcases
 
 logger = c5.logger
 
+# The commands import what they need, so the parser comes up fast
+
 def cmd_test(cmdargs):
+    import c5.test
     c5.test.main(cmdargs)
 
+def cmd_watch(cmdargs):
+    import c5.watch
+    c5.watch.main(cmdargs)
+
+def cmd_logs(cmdargs):
+    import c5.logs
+    c5.logs.main(cmdargs)
+
+def add_test_args(sp):
+    """Add the options of the commands that test commits"""
+    sp.add_argument('-b', '--base', action='store', type=str,
+                    help='Use this commit as a base instead of asking b4')
+    sp.add_argument('-a', '--arch', action='append', choices=sorted(c5.CROSS_COMPILE), default=None,
+                    help='Build for this arch, can be repeated (default: the arches of the changed files)')
+    sp.add_argument('-l', '--load-average', action='store', type=float, default=None,
+                    help='Don\'t start more make jobs while the load average is above this')
+    sp.add_argument('--fail-fast', action='store_true', default=False,
+                    help='Run the cheap testcases on the whole series first and stop at the first failure')
+    sp.add_argument('--allyesconfig', action='store_true', default=False,
+                    help='Build on allyesconfig instead of a config enabling just what the series changes')
+    sp.add_argument('--no-cache', action='store_true', default=False,
+                    help='Test all commits, even the ones with a result cached by a previous run')
+    sp.add_argument('--cache-size', action='store', type=int, default=64,
+                    help='Size limit of the result cache, in MiB')
+    sp.add_argument('--no-ccache', action='store_true', default=False,
+                    help='Don\'t build through ccache, even if it\'s installed')
+    sp.add_argument('--ccache-size', action='store', type=str, default="5G",
+                    help='Size limit of the compiler cache, like 5G')
+    sp.add_argument('--log-size', action='store', type=int, default=256,
+                    help='Size limit of the saved build logs, in MiB')
+    sp.add_argument('--timing', action='store_true', default=False,
+                    help='Show where the time went after each commit')
+    sp.add_argument('--trace', action='store', type=str, metavar='FILE',
+                    help='Save the timings of all steps in Chrome trace format')
+
+    c5.testcases.register_testcase_args(sp)
+
 def setup_parser():
     parser = argparse.ArgumentParser(
         prog='c5',
@@ -25,16 +64,33 @@ def setup_parser():
                         help='Add more debugging info to the output')
     parser.add_argument('-q', '--quiet', action='store_true', default=False,
                         help='Output critical information only')
+    parser.add_argument('--live', action='store_true', default=False,
+                        help='Show the output of the build commands as they run')
 
     subparsers = parser.add_subparsers(help='sub-command help', dest='subcmd')
 
     # c5 test
     sp_test = subparsers.add_parser('test', help='Run tests on the git tree')
-    sp_test.add_argument('-b', '--base', action='store', type=str,
-                         help='Use this commit as a base instead of asking b4')
+    sp_test.add_argument('-j', '--jobs', action='store', type=int, default=1,
+                         help='Test this many groups of commits in parallel, each in its own git worktree')
+    add_test_args(sp_test)
     sp_test.set_defaults(func=cmd_test)
 
-    c5.testcases.register_testcase_args(sp_test)
+    # c5 watch
+    sp_watch = subparsers.add_parser('watch', help='Test the changed commits whenever the branch changes')
+    sp_watch.add_argument('--interval', action='store', type=float, default=2,
+                          help='Seconds between the checks of the branch')
+    add_test_args(sp_watch)
+    sp_watch.set_defaults(func=cmd_watch, jobs=1)
+
+    # c5 logs
+    sp_logs = subparsers.add_parser('logs', help='Show the build logs saved when testing a commit')
+    sp_logs.add_argument('commit', help='The tested commit')
+    sp_logs.add_argument('testcase', nargs='?', default=None,
+                         help='Only show the logs of this testcase, like dtbs')
+    sp_logs.add_argument('--list', action='store_true', default=False,
+                         help='List the saved logs instead of showing them')
+    sp_logs.set_defaults(func=cmd_logs)
 
     return parser
 
@@ -79,6 +135,7 @@ def cmd():
         ch.setLevel(logging.INFO)
 
     logger.addHandler(ch)
+    c5.live = cmdargs.live
 
     if 'func' not in cmdargs:
         parser.print_help()
@@ -0,0 +1,157 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2023 Nikita Travkin <nikita@trvn.ru>
+
+#pylint: disable=missing-module-docstring
+
+import hashlib
+import os
+import re
+
+import c5
+import c5.cache
+
+logger = c5.logger
+
+DTC_INCLUDE = "scripts/dtc/include-prefixes"
+
+_include_pat = re.compile(r'^\s*(?:#include|/include/)\s*(?P<quote>[<"])(?P<path>[^>"]+)[>"]', re.MULTILINE)
+
+# path -> (mtime, size, included paths), kept between the commits
+_parsed = {}
+
+def _parse_includes(kernel_base, path):
+    """Return the kernel-relative paths of the files included by the file"""
+    fullpath = os.path.join(kernel_base, path)
+    try:
+        stat = os.stat(fullpath)
+    except FileNotFoundError:
+        return []
+
+    cached = _parsed.get(path)
+    if cached is not None and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+        return cached[2]
+
+    with open(fullpath, "r", errors="replace") as file:
+        text = file.read()
+
+    includes = []
+    for match in _include_pat.finditer(text):
+        # Like cpp: quoted includes are looked up next to the file first
+        dirs = [DTC_INCLUDE]
+        if match.group("quote") == '"':
+            dirs.insert(0, os.path.dirname(path))
+
+        for incdir in dirs:
+            candidate = os.path.join(kernel_base, incdir, match.group("path"))
+            if os.path.exists(candidate):
+                includes.append(os.path.relpath(os.path.realpath(candidate), os.path.realpath(kernel_base)))
+                break
+
+    _parsed[path] = (stat.st_mtime_ns, stat.st_size, includes)
+    return includes
+
+
+class IncludeGraph:
+    """Which dts files include which dtsi files and headers, for one arch"""
+
+    def __init__(self, kernel_base, arch):
+        self.included_by = {}
+
+        todo = []
+        for root, _, files in os.walk(os.path.join(kernel_base, f"arch/{arch}/boot/dts")):
+            for file in files:
+                if file.endswith((".dts", ".dtsi", ".dtso")):
+                    todo.append(os.path.relpath(os.path.join(root, file), kernel_base))
+
+        seen = set(todo)
+        while todo:
+            path = todo.pop()
+            for include in _parse_includes(kernel_base, path):
+                self.included_by.setdefault(include, set()).add(path)
+                # Headers and dtsi from other arches can include more files
+                if include not in seen:
+                    seen.add(include)
+                    todo.append(include)
+
+        logger.debug("Indexed includes of %d files for %s", len(seen), arch)
+
+    def dts_using(self, files):
+        """Return the dts files that are or include (maybe indirectly) any of the files"""
+        found = set()
+        todo = list(files)
+        seen = set(todo)
+        while todo:
+            path = todo.pop()
+            if path.endswith((".dts", ".dtso")):
+                found.add(path)
+
+            for includer in self.included_by.get(path, ()):
+                if includer not in seen:
+                    seen.add(includer)
+                    todo.append(includer)
+
+        return found
+
+
+_assign_pat = re.compile(r"^(?P<name>[\w,.-]+)-(?P<kind>dtbs|\$\(CONFIG_(?P<symbol>\w+)\)|y)\s*[:+]?=(?P<values>.*)$")
+
+# blob id of the Makefile -> its dtb index, kept between the commits
+_indexes = {}
+
+def _blob_id(data):
+    """Return the id git gives to the content"""
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+def _source_of(directory, target):
+    """Return the source of a dtb or dtbo"""
+    stem, ext = os.path.splitext(target)
+    return os.path.join(directory, stem + (".dtso" if ext == ".dtbo" else ".dts"))
+
+def _parse_dtbs(directory, text):
+    """Return the dtb index of the Makefile text"""
+    dtbs = {}
+    composites = {}
+    for line in text.replace("\\\n", " ").splitlines():
+        match = _assign_pat.match(line.split("#", 1)[0].strip())
+        if match is None:
+            continue
+
+        values = [ value for value in match.group("values").split() if "$" not in value ]
+        if match.group("kind") == "dtbs":
+            composites.setdefault(match.group("name"), []).extend(values)
+        elif match.group("name") == "dtb":
+            for target in values:
+                symbols = dtbs.setdefault(target, {"symbols": [], "sources": []})["symbols"]
+                if match.group("symbol") is not None and match.group("symbol") not in symbols:
+                    symbols.append(match.group("symbol"))
+
+    for target, entry in dtbs.items():
+        # The dtb is the base dtb with the overlays applied
+        parts = composites.get(os.path.splitext(target)[0], [target])
+        entry["sources"] = [ _source_of(directory, part) for part in parts ]
+
+    return dtbs
+
+def dtb_index(kernel_base, directory):
+    """Return the dtbs built by the Makefile in the dts directory, as a dict of
+       target -> {"symbols": [the options enabling it], "sources": [the dts and dtso it's built from]}
+    """
+    try:
+        with open(os.path.join(kernel_base, directory, "Makefile"), "rb") as file:
+            data = file.read()
+    except FileNotFoundError:
+        return None
+
+    blob = _blob_id(data)
+    index = _indexes.get((directory, blob))
+    if index is not None:
+        return index
+
+    key = c5.cache.make_key("dtbs", directory, blob)
+    index = c5.cache.get("dtb-index", key)
+    if index is None:
+        index = _parse_dtbs(directory, data.decode(errors="replace"))
+        c5.cache.put("dtb-index", key, index)
+
+    _indexes[(directory, blob)] = index
+    return index
@@ -0,0 +1,227 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2023 Nikita Travkin <nikita@trvn.ru>
+
+#pylint: disable=missing-module-docstring
+
+import atexit
+import math
+import os
+import re
+import select
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import c5
+import c5.timing
+
+logger = c5.logger
+
+# The jobserver shared by all the makes, see setup()
+current = None
+
+# Don't start more make jobs while the load average is above this, if set
+load_average = None
+
+def _read_limit(path, quota_name, period_name):
+    """Return the CPUs allowed by the quota files in the dir, or None if not limited"""
+    try:
+        if quota_name == period_name:
+            # cgroup v2 cpu.max is "$MAX $PERIOD"
+            with open(os.path.join(path, quota_name), "r") as file:
+                quota, period = file.read().split()
+        else:
+            with open(os.path.join(path, quota_name), "r") as file:
+                quota = file.read().strip()
+            with open(os.path.join(path, period_name), "r") as file:
+                period = file.read().strip()
+    except (OSError, ValueError):
+        return None
+
+    if quota in ("max", "-1"):
+        return None
+
+    return max(1, math.ceil(int(quota) / int(period)))
+
+def _cgroup_cpus():
+    """Return the CPU quota of our cgroup and its parents, or None if there is none"""
+    try:
+        with open("/proc/self/cgroup", "r") as file:
+            lines = file.read().splitlines()
+    except OSError:
+        return None
+
+    limits = []
+    for line in lines:
+        _, controllers, path = line.split(":", 2)
+        if controllers == "":
+            mount, quota_name, period_name = "/sys/fs/cgroup", "cpu.max", "cpu.max"
+        elif "cpu" in controllers.split(","):
+            mount, quota_name, period_name = f"/sys/fs/cgroup/{controllers}", "cpu.cfs_quota_us", "cpu.cfs_period_us"
+        else:
+            continue
+
+        # A quota of any parent limits us too
+        path = os.path.normpath(f"{mount}/{path}")
+        while True:
+            limit = _read_limit(path, quota_name, period_name)
+            if limit is not None:
+                limits.append(limit)
+            if path == mount:
+                break
+            path = os.path.dirname(path)
+
+    return min(limits, default=None)
+
+def available_cpus():
+    """Return the CPUs we may use, according to the affinity mask and the cgroup quota"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    quota = _cgroup_cpus()
+    if quota is not None and quota < cpus:
+        logger.debug("Limited to %d CPUs by the cgroup quota", quota)
+        cpus = quota
+
+    return cpus
+
+
+class Jobserver:
+    """A GNU make jobserver: a pipe holding a token byte per free job slot.
+
+       Every make started by c5 takes a token first and gets it as its implicit
+       slot, so all the makes together run no more jobs than there are tokens.
+       If c5 was started by make, the process already holds one implicit slot.
+    """
+
+    def __init__(self, fifo=None, fds=None, implicit=False):
+        self.fifo = fifo
+        self.implicit = implicit
+        self._fds = fds
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Worker processes have to take real tokens, the implicit slot stays here
+        return { "fifo": self.fifo, "_fds": self._fds if self.fifo is None else None, "implicit": False }
+
+    def __setstate__(self, state):
+        self.__init__(state["fifo"], state["_fds"], state["implicit"])
+
+    def fds(self):
+        """Return the (read, write) fds of the jobserver in this process"""
+        if self.fifo is not None and self._pid != os.getpid():
+            fd = os.open(self.fifo, os.O_RDWR)
+            self._fds = (fd, fd)
+            self._pid = os.getpid()
+
+        return self._fds
+
+    def makeflags(self):
+        """Return MAKEFLAGS to make a make use the jobserver"""
+        rfd, wfd = self.fds()
+        flags = f" -j --jobserver-auth={rfd},{wfd}"
+        if load_average is not None:
+            flags += f" -l{load_average}"
+
+        return flags
+
+    def acquire(self):
+        """Wait for a free slot, return its token, or None for the implicit slot"""
+        with self._lock:
+            if self.implicit:
+                self.implicit = False
+                return None
+
+        rfd, _ = self.fds()
+        with c5.timing.span("wait for a job slot", "jobserver"):
+            while True:
+                try:
+                    token = os.read(rfd, 1)
+                except BlockingIOError:
+                    # Parent makes may have made the pipe non-blocking
+                    select.select([rfd], [], [])
+                    continue
+                except InterruptedError:
+                    continue
+
+                if token:
+                    return token
+
+    def release(self, token):
+        """Return the slot taken by acquire()"""
+        if token is None:
+            with self._lock:
+                self.implicit = True
+            return
+
+        _, wfd = self.fds()
+        os.write(wfd, token)
+
+    @contextmanager
+    def token(self):
+        """Hold a job slot while in the context"""
+        token = self.acquire()
+        try:
+            yield
+        finally:
+            self.release(token)
+
+
+def _inherited():
+    """Return the jobserver of the make that started us, if any"""
+    flags = os.environ.get("MAKEFLAGS", "")
+    match = re.search(r"--jobserver-(?:auth|fds)=(?:fifo:(?P<fifo>\S+)|(?P<rfd>\d+),(?P<wfd>\d+))", flags)
+    if match is None:
+        return None
+
+    if match.group("fifo"):
+        if not os.path.exists(match.group("fifo")):
+            logger.warning("The jobserver fifo of the parent make is gone, not using it")
+            return None
+
+        return Jobserver(fifo=match.group("fifo"), implicit=True)
+
+    fds = (int(match.group("rfd")), int(match.group("wfd")))
+    try:
+        for fd in fds:
+            os.fstat(fd)
+    except OSError:
+        logger.warning("The parent make did not pass its jobserver to us, mark the recipe with '+' to share it")
+        return None
+
+    return Jobserver(fds=fds, implicit=True)
+
+def _create(tokens):
+    """Create a jobserver with the number of tokens, as a fifo to be usable by other processes"""
+    tmpdir = tempfile.mkdtemp(prefix="c5-jobserver-")
+    fifo = os.path.join(tmpdir, "fifo")
+    os.mkfifo(fifo, 0o600)
+
+    pid = os.getpid()
+    def cleanup():
+        if os.getpid() == pid:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    atexit.register(cleanup)
+
+    jobserver = Jobserver(fifo=fifo)
+    _, wfd = jobserver.fds()
+    os.write(wfd, b"+" * tokens)
+    return jobserver
+
+def setup(load=None):
+    """Join the jobserver of the parent make or create our own one"""
+    global current, load_average
+
+    load_average = load
+    current = _inherited()
+    if current is not None:
+        logger.debug("Using the jobserver of the parent make")
+        return
+
+    tokens = c5.core_count()
+    current = _create(tokens)
+    logger.debug("Created a jobserver with %d slots", tokens)
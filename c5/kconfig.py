@@ -0,0 +1,256 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2023 Nikita Travkin <nikita@trvn.ru>
+
+#pylint: disable=missing-module-docstring
+
+import functools
+import os
+import re
+
+import c5
+
+logger = c5.logger
+
+# Build on a config with just what the series needs, allyesconfig otherwise
+targeted = True
+
+# Files of the series, the config enables what is needed to build all of them
+paths = set()
+
+# Arches where the targeted config didn't work out
+_fallback = set()
+
+_assign_pat = re.compile(r"^(?P<name>[\w.-]+)-(?:\$\(CONFIG_(?P<symbol>\w+)\)|y|m|objs)\s*[:+]?=(?P<values>.*)$")
+_symbol_pat = re.compile(r"(?P<negated>!\s*)?\b(?P<symbol>[A-Z][A-Z0-9_]*)\b")
+
+# Lists of kbuild targets, the other names are composite objects
+_lists = ("obj", "lib", "dtb", "subdir", "always", "extra", "targets", "hostprogs", "userprogs")
+
+def track(files):
+    """Enable what is needed to build the files"""
+    paths.update(files)
+
+def _makefile_lines(kernel_base, directory):
+    """Return the lines of the Kbuild and Makefile in the directory, without the line continuations"""
+    lines = []
+    for name in ("Kbuild", "Makefile"):
+        try:
+            with open(os.path.join(kernel_base, directory, name), "r", errors="replace") as file:
+                text = file.read()
+        except FileNotFoundError:
+            continue
+
+        lines += text.replace("\\\n", " ").splitlines()
+
+    return lines
+
+def _assignments(kernel_base, directory):
+    """Return the (name, symbol or None, values) of the kbuild assignments in the directory"""
+    assignments = []
+    for line in _makefile_lines(kernel_base, directory):
+        match = _assign_pat.match(line.split("#", 1)[0].strip())
+        if match is not None:
+            assignments.append((match.group("name"), match.group("symbol"), match.group("values").split()))
+
+    return assignments
+
+def _target_symbols(kernel_base, directory, target, seen):
+    """Return the symbols gating the target in the directory, None if it's not found"""
+    found = False
+    symbols = set()
+    for name, symbol, values in _assignments(kernel_base, directory):
+        if target not in values:
+            continue
+
+        found = True
+        if symbol is not None:
+            symbols.add(symbol)
+
+        # Part of a composite object, which is gated too
+        if name not in _lists and f"{name}.o" not in seen:
+            seen.add(f"{name}.o")
+            composite = _target_symbols(kernel_base, directory, f"{name}.o", seen)
+            if composite is None:
+                return None
+            symbols |= composite
+
+    if not found:
+        return None
+
+    return symbols
+
+def _dir_symbols(kernel_base, directory):
+    """Return the symbols gating the descent into the directory"""
+    symbols = set()
+    while "/" in directory:
+        parent, name = os.path.split(directory)
+        found = _target_symbols(kernel_base, parent, f"{name}/", set())
+        if found is None:
+            break # Like arch/*/boot/dts, built from the arch Makefile
+        symbols |= found
+        directory = parent
+
+    return symbols
+
+def object_symbols(kernel_base, source):
+    """Return the symbols gating the object of the C source, None if they can't be found"""
+    directory, name = os.path.split(source)
+    symbols = _target_symbols(kernel_base, directory, name.replace(".c", ".o"), set())
+    if symbols is None:
+        return None
+
+    return symbols | _dir_symbols(kernel_base, directory)
+
+def dtb_symbols(kernel_base, source):
+    """Return the symbols gating the dtbs built from the dts source, or all the dtbs
+       of its dir for the other files
+    """
+    import c5.dts
+    directory = os.path.dirname(source)
+    index = c5.dts.dtb_index(kernel_base, directory) or {}
+
+    entries = [ entry for entry in index.values() if source in entry["sources"] ]
+    if len(entries) == 0:
+        entries = index.values()
+
+    symbols = set(symbol for entry in entries for symbol in entry["symbols"])
+    return symbols | _dir_symbols(kernel_base, directory)
+
+def _depends(kernel_base, arch):
+    """Return the dependencies of the symbols, from the Kconfig files of the tree and the arch"""
+    import b4
+    gitargs = ["ls-files", "--stage", "--", ":(glob)**/Kconfig*"]
+    files = tuple(tuple(line.split("\t", 1)) for line in b4.git_get_command_lines(None, gitargs))
+    return _parse_kconfigs(kernel_base, arch, files)
+
+@functools.lru_cache(maxsize=4)
+def _parse_kconfigs(kernel_base, arch, files):
+    """Parse the (stage info, path) Kconfig files, cached while their blobs stay the same"""
+    depends = {}
+    for _, path in files:
+        if c5.arch_of(path) in (None, arch):
+            _parse_kconfig(os.path.join(kernel_base, path), depends)
+
+    return depends
+
+def _parse_kconfig(path, depends):
+    """Add the depends on of the symbols in the Kconfig file, including the enclosing if and menu blocks"""
+    with open(path, "r", errors="replace") as file:
+        lines = file.read().replace("\\\n", " ").splitlines()
+
+    blocks = [] # depends of the enclosing if, menu and choice blocks
+    current = None
+    help_indent = None
+    for line in lines:
+        words = line.split(None, 1)
+        if len(words) == 0:
+            continue
+
+        # The help text ends at the first line indented less than its first line
+        indent = len(line.expandtabs()) - len(line.expandtabs().lstrip())
+        if help_indent is not None:
+            if help_indent == -1:
+                help_indent = indent
+            if indent >= help_indent:
+                continue
+            help_indent = None
+
+        keyword = words[0]
+        rest = words[1] if len(words) > 1 else ""
+        if keyword in ("config", "menuconfig"):
+            current = depends.setdefault(rest.strip(), set())
+            for block in blocks:
+                current |= block
+        elif keyword in ("if", "menu", "choice"):
+            blocks.append(_positive_symbols(rest) if keyword == "if" else set())
+            current = blocks[-1] if keyword != "if" else None
+        elif keyword in ("endif", "endmenu", "endchoice"):
+            if blocks:
+                blocks.pop()
+            current = None
+        elif keyword == "depends" and current is not None:
+            current |= _positive_symbols(rest.removeprefix("on"))
+        elif keyword in ("help", "---help---"):
+            help_indent = -1
+        elif keyword in ("comment", "source", "mainmenu"):
+            current = None
+
+def _positive_symbols(expr):
+    """Return the symbols that have to be enabled for the expression to be true, roughly"""
+    return set(match.group("symbol") for match in _symbol_pat.finditer(expr) if match.group("negated") is None)
+
+def fragment(arch):
+    """Return the symbols gating the tracked files and the config fragment enabling them
+       with their dependencies, or None if it's not known what builds the files.
+    """
+    import b4
+    kernel_base = b4.git_get_toplevel()
+
+    wanted = set()
+    for path in sorted(paths):
+        if c5.arch_of(path) not in (None, arch) or not os.path.exists(path):
+            continue # Other arches, files added later in the series
+
+        if path.endswith(".c"):
+            symbols = object_symbols(kernel_base, path)
+            if symbols is None:
+                logger.debug("Don't know what builds %s", path)
+                return None
+            wanted |= symbols
+        elif path.endswith((".dts", ".dtsi", ".dtso")):
+            wanted |= dtb_symbols(kernel_base, path)
+
+    depends = _depends(kernel_base, arch)
+    todo = list(wanted)
+    symbols = set(todo)
+    while todo:
+        for dep in depends.get(todo.pop(), ()):
+            if dep not in symbols:
+                symbols.add(dep)
+                todo.append(dep)
+
+    return wanted, "".join(f"CONFIG_{symbol}=y\n" for symbol in sorted(symbols))
+
+def config_key(arch):
+    """Return what the config of the arch is generated from, for the cache keys"""
+    if not targeted:
+        return "allyesconfig"
+
+    # It falls back to allyesconfig the same way each time
+    found = fragment(arch)
+    if found is None:
+        return "allyesconfig"
+
+    return found[1]
+
+def _enabled(builddir):
+    enabled = set()
+    with open(f"{builddir}/.config", "r") as config:
+        for line in config:
+            name, _, value = line.strip().partition("=")
+            if value in ("y", "m"):
+                enabled.add(name.removeprefix("CONFIG_"))
+
+    return enabled
+
+def configure(arch):
+    """Generate the config to build the tracked files for the arch"""
+    if not targeted or arch in _fallback:
+        c5.linux_config("allyesconfig", arch)
+        return
+
+    found = fragment(arch)
+    if found is None:
+        logger.info("Using allyesconfig for %s", arch)
+        _fallback.add(arch)
+        c5.linux_config("allyesconfig", arch)
+        return
+
+    wanted, text = found
+    c5.linux_config("allnoconfig", arch, text)
+
+    missing = wanted - _enabled(c5.linux_temp_builddir(arch))
+    if missing:
+        logger.info("Could not enable %s for %s, using allyesconfig", ", ".join(sorted(missing)), arch)
+        _fallback.add(arch)
+        c5.linux_config("allyesconfig", arch)
@@ -0,0 +1,185 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2023 Nikita Travkin <nikita@trvn.ru>
+
+#pylint: disable=missing-module-docstring
+
+import contextlib
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import sys
+import time
+
+import c5
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = c5.logger
+
+max_size = 256 * 1024 * 1024
+
+INDEX = "index.json"
+
+def logs_dir():
+    """Return the dir of the log store, shared with all the worktrees"""
+    path = f"{c5.linux_out_base()}logs/"
+    os.makedirs(path, exist_ok=True)
+    return path
+
+@contextlib.contextmanager
+def _locked_index():
+    """Yield the index entries, saved back when done. Other c5s wait for the lock."""
+    path = logs_dir()
+    with open(f"{path}index.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        entries = _load_index(path)
+        yield entries
+
+        tmppath = f"{path}{INDEX}.{os.getpid()}.tmp"
+        with open(tmppath, "w") as file:
+            json.dump(entries, file)
+        os.replace(tmppath, f"{path}{INDEX}")
+
+def _load_index(path):
+    try:
+        with open(f"{path}{INDEX}", "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return []
+
+def _object_path(path, digest):
+    """Return the path of the stored log, or None if there is no such log"""
+    for ext in (".zst", ".gz"):
+        if os.path.exists(f"{path}{digest}{ext}"):
+            return f"{path}{digest}{ext}"
+
+    return None
+
+def _write_object(path, digest, data):
+    if zstandard is not None:
+        objpath = f"{path}{digest}.zst"
+        data = zstandard.ZstdCompressor().compress(data)
+    else:
+        objpath = f"{path}{digest}.gz"
+        data = gzip.compress(data)
+
+    tmppath = f"{objpath}.{os.getpid()}.tmp"
+    with open(tmppath, "wb") as file:
+        file.write(data)
+    os.replace(tmppath, objpath)
+
+def _read_object(objpath):
+    with open(objpath, "rb") as file:
+        data = file.read()
+
+    if objpath.endswith(".zst"):
+        if zstandard is None:
+            logger.error("%s is compressed with zstd, install zstandard to read it", objpath)
+            raise RuntimeError()
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+    return gzip.decompress(data)
+
+def _add(entries, commit, testcase, phase, digest):
+    entries[:] = [ entry for entry in entries
+                   if (entry["commit"], entry["testcase"], entry["phase"]) != (commit, testcase, phase) ]
+    entries.append({
+        "commit": commit,
+        "testcase": testcase,
+        "phase": phase,
+        "digest": digest,
+        "time": time.time(),
+    })
+
+def save(logname, commit, testcase, phase=""):
+    """Move the log of the testcase on the commit into the store, return its digest"""
+    with open(logname, "rb") as file:
+        data = file.read()
+    os.remove(logname)
+
+    digest = hashlib.sha256(data).hexdigest()
+    with _locked_index() as entries:
+        path = logs_dir()
+        if _object_path(path, digest) is None:
+            _write_object(path, digest, data)
+        _add(entries, commit, testcase, phase, digest)
+        evict(entries)
+
+    logger.debug("Build log saved, see c5 logs %s %s", commit[:12], testcase)
+    return digest
+
+def link(commit, testcase, logs):
+    """Make the (phase, digest) logs saved for another commit also the logs of this one"""
+    with _locked_index() as entries:
+        path = logs_dir()
+        for phase, digest in logs:
+            if _object_path(path, digest) is not None:
+                _add(entries, commit, testcase, phase, digest)
+
+def evict(entries):
+    """Forget the oldest logs until the store fits max_size, remove the unused files"""
+    path = logs_dir()
+    sizes = {}
+    for entry in os.scandir(path):
+        digest, ext = os.path.splitext(entry.name)
+        if ext in (".zst", ".gz"):
+            sizes[digest] = entry.stat().st_size
+
+    entries[:] = [ entry for entry in entries if entry["digest"] in sizes ]
+    entries.sort(key=lambda entry: entry["time"])
+
+    used = set(entry["digest"] for entry in entries)
+    total = sum(sizes[digest] for digest in used)
+    while total > max_size and len(entries) > 0:
+        entry = entries.pop(0)
+        if not any(other["digest"] == entry["digest"] for other in entries):
+            used.discard(entry["digest"])
+            total -= sizes[entry["digest"]]
+
+    for digest in sizes.keys() - used:
+        logger.debug("Removing the log %s", digest)
+        for ext in (".zst", ".gz"):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(f"{path}{digest}{ext}")
+
+def find(commit, testcase=None):
+    """Return the index entries of the commit, optionally only of the testcase"""
+    import b4
+    lines = b4.git_get_command_lines(None, ["rev-parse", "--verify", "--quiet", f"{commit}^{{commit}}"])
+    if lines:
+        commit = lines[0]
+
+    with _locked_index() as entries:
+        found = [ entry for entry in entries if entry["commit"].startswith(commit) ]
+
+    if testcase is not None:
+        found = [ entry for entry in found if entry["testcase"] == testcase ]
+
+    return sorted(found, key=lambda entry: (entry["testcase"], entry["phase"]))
+
+def main(cmdargs):
+    """Print the build logs of a tested commit"""
+    found = find(cmdargs.commit, cmdargs.testcase)
+    if len(found) == 0:
+        logger.error("No logs saved for %s", cmdargs.commit)
+        sys.exit(1)
+
+    path = logs_dir()
+    for entry in found:
+        name = " ".join(part for part in (entry["commit"][:12], entry["testcase"], entry["phase"]) if part)
+        if cmdargs.list:
+            print(f"{name}: {time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['time']))}")
+            continue
+
+        objpath = _object_path(path, entry["digest"])
+        if objpath is None:
+            continue
+
+        if len(found) > 1:
+            print(f"==> {name} <==")
+        sys.stdout.write(_read_object(objpath).decode(errors="replace"))
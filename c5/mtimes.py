@@ -0,0 +1,89 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2023 Nikita Travkin <nikita@trvn.ru>
+
+#pylint: disable=missing-module-docstring
+
+import hashlib
+import json
+import os
+
+import c5
+import c5.timing
+
+logger = c5.logger
+
+# Files that git or the testcases may rewrite while testing, relative to the kernel dir
+paths = set()
+
+RECORD = ".c5-mtimes.json"
+
+def track(files):
+    """Keep the mtimes of the files if their content doesn't really change"""
+    paths.update(files)
+
+def _hash(path):
+    with open(path, "rb") as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+def _load(builddir):
+    try:
+        with open(os.path.join(builddir, RECORD), "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def _save(builddir, record):
+    path = os.path.join(builddir, RECORD)
+    tmppath = f"{path}.{os.getpid()}.tmp"
+    with open(tmppath, "w") as file:
+        json.dump(record, file)
+    os.replace(tmppath, path)
+
+def _builddirs():
+    """Return the build dirs that build from the current sources"""
+    out = c5.linux_out_dir()
+    return [ f"{out}{arch}/" for arch in c5.CROSS_COMPILE if os.path.exists(f"{out}{arch}/.config") ]
+
+def prepare(builddir):
+    """Give the tracked files back the mtime they had when they were last built,
+       if every build dir last built them with the same content as they have now,
+       and record what the build in builddir is going to see.
+
+       git and sed rewrite the files with a new mtime even if the content ends up
+       the same, kbuild would then rebuild everything that depends on them.
+    """
+    if len(paths) == 0:
+        return
+
+    with c5.timing.span("restore mtimes", "mtimes"):
+        records = [ _load(other) for other in _builddirs() if other != builddir ]
+        record = _load(builddir)
+        if os.path.exists(f"{builddir}/.config"):
+            records.append(record)
+
+        restored = 0
+        for path in sorted(paths):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+
+            digest = _hash(path)
+            mtime = stat.st_mtime_ns
+
+            # A build dir that never saw the file may have built it from anything
+            seen = [ other.get(path) for other in records ]
+            if len(seen) > 0 and all(entry is not None and entry[0] == digest for entry in seen):
+                # Objects in all the build dirs are newer than the oldest of the mtimes
+                oldest = min(entry[1] for entry in seen)
+                if oldest != mtime:
+                    os.utime(path, ns=(stat.st_atime_ns, oldest))
+                    mtime = oldest
+                    restored += 1
+
+            record[path] = [digest, mtime]
+
+        _save(builddir, record)
+
+    if restored > 0:
+        logger.debug("Restored the mtimes of %d unchanged files", restored)
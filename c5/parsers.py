@@ -0,0 +1,188 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2023 Nikita Travkin <nikita@trvn.ru>
+
+#pylint: disable=missing-module-docstring
+
+import collections
+import hashlib
+import os
+import re
+
+import c5
+
+# One message per line, the first pattern that matches wins
+PATTERNS = [
+    # drivers/foo.c:12:5: warning: unused variable 'x' [-Wunused-variable]
+    ("cc", re.compile(r"^(?P<file>[^\s:]+):(?P<line>\d+):(?:\d+:)? (?P<severity>warning|error|fatal error|note): "
+                      r"(?P<message>.*?)(?: \[(?P<check>-W[^\]]+)\])?$")),
+    # arch/arm64/boot/dts/foo.dtsi:12.3-20: Warning (reg_format): /soc/foo@1:reg: property has invalid length
+    ("dtc", re.compile(r"^(?P<file>\S+\.dt(?:si?|so|bo?)):(?:(?P<line>[\d.-]+):)? (?:Warning|ERROR) "
+                       r"\((?P<check>[\w-]+)\): (?:(?P<node>/\S*): )?(?P<message>.*)$")),
+    # .../foo.dtb: soc@0/foo@1: compatible: ['bar'] is too short
+    ("dtbs", re.compile(r"^(?P<file>\S+\.dtb): (?P<node>[^\s:]+(?: \([^)]*\))?): (?P<message>.*)$")),
+    # Documentation/devicetree/bindings/foo.yaml:12:1: [warning] wrong indentation (indentation)
+    ("yamllint", re.compile(r"^(?P<file>\S+\.yaml):(?P<line>\d+):\d+: \[(?P<severity>warning|error)\] "
+                            r"(?P<message>.*?)(?: \((?P<check>[\w-]+)\))?$")),
+    # Documentation/devicetree/bindings/foo.yaml: properties:compatible: 'oneOf' conditional failed
+    ("dt-schema", re.compile(r"^(?P<file>\S+\.yaml):(?: (?P<node>[\w$#@,./:-]+):)? (?P<message>.*)$")),
+]
+
+# gcc prints where the message comes from before the message
+CONTEXT = re.compile(r"^(?:In file included from |\S+: In \w+ |\S+: At top level:)")
+INCLUDED_FROM = re.compile(r"^\s+from \S+[:,]$")
+
+# dt-validate names the schema after the message
+SCHEMA = re.compile(r"^\s+from schema \$id: (?P<schema>\S+)")
+
+# The build dir and worktree parts of the paths change between the runs
+OUT_DIR = re.compile(r"(?<![^\s'\"])(?:[^\s:'\"]*/)?\.c5-out/(?:worktrees/[^/\s]+/|(?:build-[^/\s]+/)?(?:%s)/)"
+                     % "|".join(c5.CROSS_COMPILE))
+RELATIVE = re.compile(r"^(?:\.\.?/)+")
+
+# dtc points at the source, like "also defined at foo.dts:40.8-45.3"
+POSITION = re.compile(r":\d+\.\d+-\d+(?:\.\d+)?\b")
+
+def normalize(text):
+    """Drop the parts of the paths in the text that depend on where c5 built them"""
+    if ".c5-out/" in text:
+        text = OUT_DIR.sub("", text)
+    cwd = os.getcwd() + "/"
+    return text.replace(cwd, "")
+
+def tree_path(path):
+    """Return the path relative to the tree, also when make printed it relative to the build dir"""
+    return RELATIVE.sub("", normalize(path))
+
+class Diagnostic:
+    """A message of one of the tools, with the lines that belong to it"""
+
+    def __init__(self, tool, match, lines):
+        groups = match.groupdict()
+        self.tool = tool
+        self.file = tree_path(groups["file"])
+        self.line = groups.get("line")
+        self.node = groups.get("node")
+        self.check = groups.get("check")
+        self.severity = groups.get("severity")
+        self.message = " ".join(normalize(groups["message"]).split())
+        self.lines = lines
+        self.details = []
+
+    def add(self, line):
+        """Add a line following the message, like a note or a detail of dt-validate"""
+        self.lines.append(line)
+        schema = SCHEMA.match(line)
+        if schema is not None:
+            if self.check is None:
+                self.check = schema.group("schema")
+        elif line[:1] in (" ", "\t") and self.tool != "cc": # gcc and clang quote the source
+            self.details.append(" ".join(tree_path(word) for word in POSITION.sub("", line).split()))
+
+    def key(self):
+        """Hash of what the message is about. The line is left out, it moves when the file
+           changes elsewhere, and so are the source snippets.
+        """
+        parts = (self.tool, self.file, self.node, self.check, self.severity, self.message, *self.details)
+        return hashlib.sha1("\0".join(part or "" for part in parts).encode()).hexdigest()
+
+    def text(self):
+        return "".join(self.lines)
+
+def _match(line):
+    for tool, pattern in PATTERNS:
+        match = pattern.match(line.rstrip("\n"))
+        if match is not None:
+            return tool, match
+
+    return None, None
+
+class Parser:
+    """Split a log into Diagnostics as it arrives. feed() returns the items the line
+       completes, in order with the lines no pattern recognizes.
+    """
+
+    def __init__(self):
+        self.current = None
+        self.context = []
+
+    def _finish(self):
+        done = [self.current] if self.current is not None else []
+        self.current = None
+        return done
+
+    def feed(self, line):
+        tool, match = _match(line)
+        if match is not None and not (match.groupdict().get("severity") == "note" and self.current is not None):
+            done = self._finish()
+            self.current = Diagnostic(tool, match, self.context + [line])
+            self.context = []
+            return done
+
+        if CONTEXT.match(line) or (len(self.context) > 0 and INCLUDED_FROM.match(line)):
+            self.context.append(line)
+            return self._finish()
+
+        # The source snippets, notes and indented details of the last message
+        if self.current is not None and len(self.context) == 0 and (match is not None or line[:1] in (" ", "\t")):
+            self.current.add(line)
+            return []
+
+        done = self._finish() + self.context + [line]
+        self.context = []
+        return done
+
+    def flush(self):
+        """Return the items left at the end of the log"""
+        done = self._finish() + self.context
+        self.context = []
+        return done
+
+def parse(text):
+    """Split a log into Diagnostics, in order with the lines no pattern recognizes"""
+    parser = Parser()
+    items = []
+    for line in text.splitlines(keepends=True):
+        items += parser.feed(line)
+
+    return items + parser.flush()
+
+class MessageFilter:
+    """Pick the messages that are not in the old log as the new log arrives.
+       Recognized messages are compared by their key, each old message cancels out
+       one new message with the same key. Only the other lines are compared with
+       the fuzzy LineMatcher. Each message is checked as soon as it is complete.
+    """
+
+    def __init__(self, old, fuzzy=0.98):
+        old_items = parse(old)
+        self.known = collections.Counter(item.key() for item in old_items if isinstance(item, Diagnostic))
+        old_lines = [ item for item in old_items if isinstance(item, str) ]
+        self.matcher = c5.LineMatcher(old_lines, fuzzy) if len(old_lines) > 0 else None
+        self.parser = Parser()
+        self.reported = set()
+        self.new = []
+
+    def _check(self, item):
+        if isinstance(item, str):
+            if item not in self.reported:
+                self.reported.add(item)
+                if self.matcher is None or not self.matcher.matches(item):
+                    self.new.append(item)
+            return
+
+        key = item.key()
+        if self.known[key] > 0:
+            self.known[key] -= 1
+        elif key not in self.reported:
+            self.reported.add(key)
+            self.new.append(item.text())
+
+    def feed(self, line):
+        for item in self.parser.feed(line):
+            self._check(item)
+
+    def text(self):
+        for item in self.parser.flush():
+            self._check(item)
+
+        return "".join(self.new)
@@ -4,29 +4,44 @@
 #pylint: disable=missing-function-docstring
 #pylint: disable=missing-module-docstring
 
+import logging
+import os
 import sys
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import contextmanager
 
 import b4
 
 import c5
+import c5.cache
+import c5.ccache
+import c5.jobserver
+import c5.kconfig
+import c5.logs
+import c5.mtimes
 import c5.testcases
+import c5.timing
 
 logger = c5.logger
 
-def git_get_commits_after(base_commit):
-    gitargs = ["log", "--format=\"%H\"", f"{base_commit}..HEAD"]
-    lines = b4.git_get_command_lines(None, gitargs)
-    lines.reverse()
-    return [ line.replace("\"", "") for line in lines ]
+def git_rev_parse(rev):
+    lines = b4.git_get_command_lines(None, ["rev-parse", "--verify", f"{rev}^{{commit}}"])
+    if not lines:
+        raise RuntimeError()
+    return lines[0]
 
-def git_checkout(commit, detach=True):
+def git_checkout(commit, detach=True, force=False):
     gitargs = ["checkout"]
+    if force:
+        gitargs.append("--force")
     if detach:
         gitargs.append("--detach")
 
     gitargs.append(commit)
-    b4.git_get_command_lines(None, gitargs)
+    with c5.timing.span("git checkout", "git"):
+        b4.git_get_command_lines(None, gitargs)
 
 @contextmanager
 def git_detached_head(base_commit):
@@ -38,27 +53,320 @@ def git_detached_head(base_commit):
 
 def git_cherry_pick(commit):
     gitargs = ["cherry-pick", commit]
+    with c5.timing.span("git cherry-pick", "git"):
+        ecode, _ = b4.git_run_command(None, gitargs)
+    if ecode:
+        raise RuntimeError()
+
+def git_worktree_add(path, commit):
+    if os.path.exists(path):
+        # Keep the worktree from the previous run, its sources are still warm.
+        return
+
+    b4.git_run_command(None, ["worktree", "prune"])
+    gitargs = ["worktree", "add", "--detach", path, commit]
     ecode, _ = b4.git_run_command(None, gitargs)
     if ecode:
         raise RuntimeError()
 
-def apply_and_test(commit, cmdargs=None):
+class Scheduler:
+    """Run a testcase phase on many testcases concurrently, as far as the
+       resources declared by the testcases allow.
+    """
+
+    def __init__(self, phase):
+        self.phase = phase
+        self.cond = threading.Condition()
+        self.limit = c5.jobserver.available_cpus()
+        self.cpus = 0
+        self.running = 0
+        self.builddir = False
+        self.exclusive = False
+
+    def _cpus(self, case):
+        return case.cpus if case.cpus is not None else c5.core_count()
+
+    def _exclusive(self, case):
+        return self.phase == "run" and case.mutates_tree
+
+    def _can_start(self, case):
+        if self.exclusive:
+            return False
+        if self.running == 0:
+            return True
+        if self._exclusive(case):
+            return False
+        if case.uses_builddir and self.builddir:
+            return False
+
+        return self.cpus + self._cpus(case) <= self.limit
+
+    def _acquire(self, case):
+        with self.cond:
+            self.cond.wait_for(lambda: self._can_start(case))
+            self.running += 1
+            self.cpus += self._cpus(case)
+            self.builddir = self.builddir or case.uses_builddir
+            self.exclusive = self._exclusive(case)
+
+    def _release(self, case):
+        with self.cond:
+            self.running -= 1
+            self.cpus -= self._cpus(case)
+            if case.uses_builddir:
+                self.builddir = False
+            if self._exclusive(case):
+                self.exclusive = False
+            self.cond.notify_all()
+
+    def _worker(self, case, slot):
+        with c5.capture_log() as records:
+            slot["records"] = records
+            self._acquire(case)
+            try:
+                logger.debug("%s testcase: %s", "Preparing" if self.phase == "prep" else "Running", case.desc)
+                with c5.timing.span(f"{case.desc} {self.phase}", "testcase"):
+                    slot["result"] = getattr(case, self.phase)()
+            except Exception as ex: # Re-raised in the main thread
+                slot["error"] = ex
+            finally:
+                self._release(case)
+
+    def run(self, cases):
+        """Run the phase on all cases, print their logs in order and return the results"""
+        slots = [ {"records": [], "result": None, "error": None} for _ in cases ]
+        threads = [ threading.Thread(target=self._worker, args=(case, slot))
+                    for case, slot in zip(cases, slots) ]
+
+        for thread in threads:
+            thread.start()
+
+        error = None
+        for thread, slot in zip(threads, slots):
+            thread.join()
+            c5.replay_log(slot["records"])
+            if error is None:
+                error = slot["error"]
+
+        if error is not None:
+            raise error
+
+        return [ slot["result"] for slot in slots ]
+
+def apply_and_test(commit, cmdargs=None, series=None, testcases=None):
+    c5.timing.commit = commit
+    with c5.timing.span("total", "commit"):
+        results = _apply_and_test(commit, cmdargs, series, testcases)
+
+    level = logging.INFO if getattr(cmdargs, "timing", False) else logging.DEBUG
+    logger.log(level, "Time spent on '%s':\n%s", commit[:12], c5.timing.summary(commit))
+
+    return results
+
+def _apply_and_test(commit, cmdargs, series, testcase_list):
+    info = series[commit] if series is not None else None
+    if info is not None and info.parent_tree is not None:
+        parent_tree = info.parent_tree
+    else:
+        parent_tree = c5.git_get_tree()
+    if testcase_list is None:
+        testcase_list = c5.testcases.get_testcases(cmdargs)
+
+    cases = []
     testcases = []
-    for testcase in c5.testcases.get_testcases():
-        case = testcase(commit, cmdargs)
-        if case.applies():
-            logger.debug("Preparing testcase: %s", testcase.desc)
-            case.prep()
-            testcases.append(case)
+    results = {}
+    keys = {}
+    for testcase in testcase_list:
+        case = testcase(commit, cmdargs, info)
+        if not case.applies():
+            continue
+
+        cases.append(case)
+        if c5.cache.enabled:
+            keys[case] = case.cache_key(parent_tree)
+            cached = c5.cache.get_result(keys[case])
+            if cached is not None:
+                results[case], logs = cached
+                logger.info("Reusing the result of '%s' from a previous run", case.desc)
+                if results[case].msg:
+                    logger.info("%s", results[case].msg)
+                if logs:
+                    c5.logs.link(commit, case.name(), logs)
+                continue
+
+        testcases.append(case)
+
+    Scheduler("prep").run(testcases)
 
     git_cherry_pick(commit)
 
-    for case in testcases:
-        logger.debug("Running testcase: %s", case.desc)
-        case.run()
+    for case, result in zip(testcases, Scheduler("run").run(testcases)):
+        results[case] = result
+        if case in keys and result is not None:
+            c5.cache.put_result(keys[case], result, case.logs)
 
+    return [ results[case] for case in cases ]
 
-def main(cmdargs):
+
+def split_commits(base_commit, commits, jobs):
+    """Split the series into up to 'jobs' groups of consecutive commits.
+       Returns a list of (parent, commits) tuples.
+    """
+    jobs = min(jobs, len(commits))
+    groups = []
+    start = 0
+    for i in range(jobs):
+        end = start + (len(commits) - start) // (jobs - i)
+        parent = commits[start - 1] if start > 0 else base_commit
+        groups.append((parent, commits[start:end]))
+        start = end
+
+    return groups
+
+def plan(cmdargs):
+    """Return the testcases to run in each pass over the series.
+       With --fail-fast the cheap testcases check the whole series before the others start.
+    """
+    testcases = c5.testcases.get_testcases(cmdargs)
+    if not cmdargs.fail_fast:
+        return [testcases]
+
+    passes = [ [ testcase for testcase in testcases if testcase.cost < c5.testcases.CHEAP_COST ],
+               [ testcase for testcase in testcases if testcase.cost >= c5.testcases.CHEAP_COST ] ]
+    return [ testcases for testcases in passes if len(testcases) > 0 ]
+
+def test_commits(parent, commits, cmdargs, series, testcases):
+    """Test the commits on top of parent, return the ones with a TestFail.
+       With --fail-fast the testing stops at the first one.
+    """
+    # Checking out the commits rewrites their files
+    c5.mtimes.track(path for info in series.commits for path in info.files)
+    c5.kconfig.track(path for info in series.commits for path in info.files)
+
+    git_checkout(parent)
+    failed = []
+    for commit in commits:
+        logger.info("Testing commit '%s' %s", commit[:12], series[commit].subject)
+        if not cmdargs.fail_fast:
+            results = apply_and_test(commit, cmdargs, series, testcases)
+            if any(isinstance(result, c5.testcases.TestFail) for result in results):
+                failed.append(commit)
+            continue
+
+        try:
+            results = apply_and_test(commit, cmdargs, series, testcases)
+        except Exception as ex: # Reported as a failure, like TestFail
+            logger.debug("%s", traceback.format_exc())
+            logger.error("Testing commit '%s' failed: %s", commit[:12], ex or type(ex).__name__)
+            return [commit]
+
+        if any(isinstance(result, c5.testcases.TestFail) for result in results):
+            return [commit]
+
+    return failed
+
+def report_skipped(skipped, cmdargs, series):
+    """Log the testcases that were not run on the commits, given as (commit, testcases) tuples"""
+    lines = []
+    found = []
+    for commit, testcases in skipped:
+        name = f"'{commit[:12]}' {series[commit].subject}"
+        descs = []
+        for testcase in testcases:
+            if not testcase(commit, cmdargs, series[commit]).applies():
+                continue
+
+            # Tested with the whole series already
+            result = testcase.series_result(commit)
+            if result is None:
+                descs.append(testcase.desc)
+            elif result.msg:
+                found.append(f"{name}: {testcase.desc}:\n{result.msg}")
+
+        if len(descs) > 0:
+            lines.append(f"{name}: {', '.join(descs)}")
+
+    if len(found) > 0:
+        logger.info("Found when testing the whole series:\n%s", "\n".join(found))
+    if len(lines) > 0:
+        logger.info("Skipped because of the failure:\n%s", "\n".join(lines))
+
+def _test_worktree(slot, parent, commits, cmdargs, series, jobserver, phase):
+    """Test the commits on top of parent in the worktree.
+       Return the log, the error and the commits with a TestFail.
+    """
+    out_base = c5.linux_out_base()
+    os.chdir(f"{out_base}worktrees/{slot}")
+    c5.builddir = f"{out_base}build-{slot}/"
+    c5.cores = max(1, c5.core_count() // cmdargs.jobs)
+    configure(cmdargs, jobserver=False)
+    c5.jobserver.current = jobserver
+    c5.jobserver.load_average = cmdargs.load_average
+    c5.timing.events = []
+
+    with c5.capture_log() as records:
+        try:
+            git_checkout(parent, force=True)
+            failed = test_commits(parent, commits, cmdargs, series, plan(cmdargs)[phase])
+        except Exception as ex: # Re-raised by the parent once the log is printed
+            logger.debug("%s", traceback.format_exc())
+            return records, ex, c5.timing.events, []
+
+    return records, None, c5.timing.events, failed
+
+def commits_after(commits, failed):
+    """Return the commits after the failed one"""
+    if failed is None:
+        return []
+
+    return commits[commits.index(failed) + 1:]
+
+def test_parallel(base_commit, commits, cmdargs, series, phase=0):
+    """Test groups of commits in parallel, each in its own worktree and build dir.
+       Return the commits with a TestFail and the ones left untested after them with --fail-fast.
+    """
+    groups = split_commits(base_commit, commits, cmdargs.jobs)
+    out_base = c5.linux_out_base()
+
+    for slot, (parent, _) in enumerate(groups):
+        git_worktree_add(f"{out_base}worktrees/{slot}", parent)
+
+    with ProcessPoolExecutor(max_workers=len(groups)) as pool:
+        futures = [ pool.submit(_test_worktree, slot, parent, group, cmdargs, series, c5.jobserver.current, phase)
+                    for slot, (parent, group) in enumerate(groups) ]
+
+        failed = []
+        untested = []
+        for future, (_, group) in zip(futures, groups):
+            records, ex, events, group_failed = future.result()
+            c5.replay_log(records)
+            c5.timing.events.extend(events)
+            if ex is not None:
+                pool.shutdown(cancel_futures=True)
+                raise ex
+
+            failed += group_failed
+            if cmdargs.fail_fast and len(group_failed) > 0:
+                untested += commits_after(group, group_failed[-1])
+
+    return failed, untested
+
+def configure(cmdargs, jobserver=True):
+    """Apply the options shared by the commands that test commits. The workers
+       of test_parallel() get the jobserver of the parent instead of a new one.
+    """
+    c5.cache.enabled = not cmdargs.no_cache
+    c5.cache.max_size = cmdargs.cache_size * 1024 * 1024
+    c5.ccache.enabled = not cmdargs.no_ccache
+    c5.ccache.max_size = cmdargs.ccache_size
+    c5.logs.max_size = cmdargs.log_size * 1024 * 1024
+    c5.kconfig.targeted = not cmdargs.allyesconfig
+    if jobserver:
+        c5.jobserver.setup(cmdargs.load_average)
+    c5.arches = cmdargs.arch
+
+def find_base(cmdargs):
+    """Return the base commit from the options or b4, exit if there is none"""
     if cmdargs.base:
         base_commit = cmdargs.base
     else:
@@ -68,17 +376,55 @@ def main(cmdargs):
         logger.error("Base commit not found. Checkout a b4 tracked branch or use --base <hash>.")
         sys.exit(1)
 
+    # Refs like HEAD~3 would point elsewhere once HEAD moves
+    base_commit = git_rev_parse(base_commit)
+
     logger.debug("Base commit is '%s' %s", base_commit[:12], c5.git_get_commit_subject(base_commit))
+    return base_commit
 
-    commits = git_get_commits_after(base_commit)
+def main(cmdargs):
+    configure(cmdargs)
+    base_commit = find_base(cmdargs)
+
+    series = c5.SeriesIndex(base_commit)
+    commits = [ info.commit for info in series.commits ]
     if not commits:
         logger.info("Nothing to test")
     else:
         logger.info("Will test %d commits", len(commits))
 
-    with git_detached_head(base_commit):
-        for commit in commits:
-            logger.info("Testing commit '%s' %s", commit[:12], c5.git_get_commit_subject(commit))
-            apply_and_test(commit, cmdargs)
+    passes = plan(cmdargs)
+    ccache_stats = c5.ccache.stats()
+    try:
+        for testcase in c5.testcases.get_testcases(cmdargs):
+            testcase.series_prep(base_commit, series, cmdargs)
+
+        all_failed = []
+        for phase, testcases in enumerate(passes):
+            if len(passes) > 1:
+                logger.info("Checking the series with: %s", ", ".join(testcase.desc for testcase in testcases))
+
+            if cmdargs.jobs > 1 and len(commits) > 1:
+                failed, untested = test_parallel(base_commit, commits, cmdargs, series, phase)
+            else:
+                with git_detached_head(base_commit):
+                    failed = test_commits(base_commit, commits, cmdargs, series, testcases)
+                untested = commits_after(commits, failed[-1]) if cmdargs.fail_fast and failed else []
+
+            all_failed += failed
+            if cmdargs.fail_fast and len(failed) > 0:
+                logger.error("Stopping at the failure in %s", ", ".join(f"'{commit[:12]}'" for commit in failed))
+                skipped = [ (commit, testcases) for commit in untested ]
+                skipped += [ (commit, later) for later in passes[phase + 1:] for commit in commits ]
+                report_skipped(skipped, cmdargs, series)
+                sys.exit(1)
 
         logger.info("Done!")
+        if len(all_failed) > 0:
+            logger.error("Failed: %s", ", ".join(f"'{commit[:12]}' {series[commit].subject}" for commit in all_failed))
+            sys.exit(1)
+    finally:
+        c5.ccache.report(ccache_stats)
+        if cmdargs.trace:
+            c5.timing.write_trace(cmdargs.trace)
+            logger.info("Trace saved in %s", cmdargs.trace)
@@ -5,19 +5,76 @@
 #pylint: disable=missing-module-docstring
 
 import argparse
+import functools
+import hashlib
+import importlib
+import inspect
 
 import c5
+import c5.cache
 
 logger = c5.logger
 
-_testcases = []
+_specs = []
+
+# Testcases cheaper than this check the whole series first with --fail-fast
+CHEAP_COST = 20
 
 class TestCase:
     """A patch test case"""
 
-    def __init__(self, commit=None, cmdargs=None):
+    # Resources needed by the testcase, used to run testcases concurrently.
+    uses_builddir = False   # Needs exclusive use of the build dir
+    cpus = 1                # Cores used, None for all of c5.core_count()
+    mutates_tree = False    # run() modifies the checked out sources
+
+    # Rough relative run time, used to plan the order of the testcases
+    cost = 100
+
+    # External tools whose versions affect the result, {CROSS_COMPILE} is
+    # replaced with the cross compiler prefix of each arch
+    tools = []
+
+    def __init__(self, commit=None, cmdargs=None, info=None):
         self.commit = commit
         self._cmdargs = vars(cmdargs)
+        self.info = info
+        self.logs = []
+
+    @classmethod
+    def name(cls):
+        """Return the short name of the testcase, like dtbs"""
+        return cls.__name__.replace("TestCase", "").lower()
+
+    def changed_files(self):
+        """Return the files changed by the commit"""
+        if self.info is not None:
+            return list(self.info.files)
+
+        return c5.git_get_changed_files(self.commit)
+
+    def arches(self):
+        """Return the arches to build the commit for"""
+        return c5.arches_for(self.changed_files())
+
+    def tool_versions(self):
+        """Return the versions of the tools used"""
+        versions = []
+        for tool in self.tools:
+            if "{CROSS_COMPILE}" in tool:
+                versions += [ c5.tool_version(tool.format(CROSS_COMPILE=c5.CROSS_COMPILE[arch]))
+                              for arch in self.arches() ]
+            else:
+                versions.append(c5.tool_version(tool))
+
+        return versions
+
+    def patch_id(self):
+        """Return the patch-id of the commit"""
+        if self.info is not None and self.info.patch_id is not None:
+            return self.info.patch_id
+
+        return c5.git_get_patch_id(self.commit)
 
     def applies(self):
         """Does this testcase apply to the top commit?"""
@@ -29,6 +86,17 @@ class TestCase:
     def _applies(self):
         return True # Never skip by default
 
+    @classmethod
+    def series_prep(cls, base_commit, series, cmdargs):
+        """Do whatever can be done for all the commits of the series at once,
+           before any of them is tested.
+        """
+
+    @classmethod
+    def series_result(cls, commit):
+        """Return the result series_prep() got for the commit, None if it didn't test it"""
+        return None
+
     def prep(self):
         """Do whatever is necessary to prepare for the testing"""
 
@@ -36,6 +104,43 @@ class TestCase:
         """Do whatever is necessary to test the top commit"""
         raise NotImplementedError()
 
+    def cache_key(self, parent_tree):
+        """Key of the result of this testcase for the commit applied on parent_tree"""
+        import c5.kconfig
+        prefix = type(self).__name__.replace("TestCase", "").lower() + "_"
+        options = { name: value for name, value in self._cmdargs.items() if name.startswith(prefix) }
+
+        with open(inspect.getsourcefile(type(self)), "rb") as source:
+            code = hashlib.sha256(source.read()).hexdigest()
+
+        return c5.cache.make_key(
+            self.patch_id(),
+            parent_tree,
+            type(self).__name__,
+            code,
+            options,
+            self.arches(),
+            self.tool_versions(),
+            self.uses_builddir and [ c5.kconfig.config_key(arch) for arch in self.arches() ],
+        )
+
+    def baseline_key(self, tree, *parts):
+        """Key of the warnings of this testcase on the tree, before any change is applied"""
+        import c5.kconfig
+        return c5.cache.make_key(
+            tree,
+            type(self).__name__,
+            self.tool_versions(),
+            self.uses_builddir and c5.kconfig.targeted,
+            parts,
+        )
+
+    def save_log(self, logname, *phase):
+        """Move the build log into the log store, phase tells the builds of the commit apart"""
+        import c5.logs
+        phase = "-".join(part.strip("-") for part in phase if part)
+        self.logs.append((phase, c5.logs.save(logname, self.commit, self.name(), phase)))
+
     def get_arg(self, name):
         """Get the argument value"""
         name = type(self).__name__.replace("TestCase", "").lower() + "_" + name
@@ -44,22 +149,6 @@ class TestCase:
 
         return None
 
-    @classmethod
-    def add_arg(cls, parser : argparse.ArgumentParser, name, action="store_true", default=False, help=None):
-        """Add an argument for this testcase"""
-        name = "--" + cls.__name__.replace("TestCase", "").lower() + "_" + name
-        parser.add_argument(name, action=action, default=default, help=help)
-
-    @classmethod
-    def register_args(cls, parser : argparse.ArgumentParser):
-        """Register testcase cmdline args."""
-        cls.add_arg(parser, "skip", help=f"skip the '{cls.__name__.replace('TestCase', '')}' testcase")
-        cls._register_args(parser)
-
-    @classmethod
-    def _register_args(cls, parser):
-        pass # Nothing extra by default
-
 
 class TestResult:
     """Result of the test run"""
@@ -86,48 +175,71 @@ class TestFail(TestResult):
     severity = 3
 
 
-def register_testcase(priority=1000):
-    """Register a TestCase.
-       The bigger the priority value the later the test will run.
-    """
-    def _register(cla):
-        _testcases.append((cla, priority))
-        return cla
-    return _register
+class TestCaseSpec:
+    """What c5 needs to know about a testcase before its module is imported"""
+
+    def __init__(self, name, target, priority=1000, args=()):
+        self.name = name            # Prefix of the options, the name of the class without TestCase, lowercase
+        self.target = target        # "module:Class" of the TestCase
+        self.priority = priority    # The bigger the priority value the later the test will run
+        self.args = args            # (name, add_argument() kwargs) of the extra options
 
+    def load(self):
+        """Import the TestCase"""
+        modulename, _, classname = self.target.partition(":")
+        return getattr(importlib.import_module(modulename), classname)
 
-def get_testcases():
-    return [ tup[0] for tup in sorted(_testcases, key=lambda tup: tup[1])]
+    def add_arg(self, parser : argparse.ArgumentParser, name, action="store_true", default=False, **kwargs):
+        """Add an argument for this testcase"""
+        parser.add_argument(f"--{self.name}_{name}", action=action, default=default, **kwargs)
+
+    def register_args(self, parser : argparse.ArgumentParser):
+        """Register testcase cmdline args."""
+        self.add_arg(parser, "skip", help=f"skip the '{self.name}' testcase")
+        for name, kwargs in self.args:
+            self.add_arg(parser, name, **kwargs)
+
+
+def register_testcase(spec):
+    """Register a TestCaseSpec"""
+    _specs.append(spec)
+
+register_testcase(TestCaseSpec("checkpatch", "c5.testcases.checkpatch:CheckPatchTestCase", priority=100))
+register_testcase(TestCaseSpec("dtschema", "c5.testcases.dt_schema:DtSchemaTestCase", priority=500))
+register_testcase(TestCaseSpec("compile", "c5.testcases.compile:CompileTestCase", priority=700))
+register_testcase(TestCaseSpec("dtbs", "c5.testcases.dtbs:DtbsTestCase", priority=700, args=[
+    ("filter", {"action": "store", "help": "Filter to use when looking up which dtb files to check."}),
+]))
+
+def _register_plugins():
+    """Register the specs from the c5.testcases entry points of the installed packages"""
+    import importlib.metadata
+    eps = importlib.metadata.entry_points()
+    eps = eps.select(group="c5.testcases") if hasattr(eps, "select") else eps.get("c5.testcases", [])
+    for ep in eps:
+        try:
+            spec = ep.load()
+        except Exception: # A broken plugin shouldn't break c5
+            logger.warning("Failed to load the testcase plugin %s", ep.value)
+            continue
+
+        if not isinstance(spec, TestCaseSpec):
+            logger.warning("The testcase plugin %s is not a TestCaseSpec", ep.value)
+            continue
+
+        register_testcase(spec)
+
+@functools.lru_cache(maxsize=None)
+def get_specs():
+    """Return the specs of all the testcases, in the order they run"""
+    _register_plugins()
+    return sorted(_specs, key=lambda spec: spec.priority)
+
+def get_testcases(cmdargs=None):
+    """Import and return the testcases, except the ones skipped in cmdargs"""
+    skipped = vars(cmdargs) if cmdargs is not None else {}
+    return [ spec.load() for spec in get_specs() if not skipped.get(f"{spec.name}_skip") ]
 
 def register_testcase_args(parser):
-    cases = get_testcases()
-
-    for case in cases:
-        case.register_args(parser)
-
-# https://stackoverflow.com/a/5135444
-def _import_package_files():
-    """ Dynamically import all the public attributes of the python modules in this
-        file's directory (the package directory) and return a list of their names.
-    """
-    import os
-    exports = []
-    globals_, locals_ = globals(), locals()
-    package_path = os.path.dirname(__file__)
-    package_name = os.path.basename(package_path)
-
-    for filename in os.listdir(package_path):
-        modulename, ext = os.path.splitext(filename)
-        if modulename[0] != '_' and ext in ('.py', '.pyw'):
-            subpackage = '{}.{}'.format(package_name, modulename) # pkg relative
-            module = __import__(subpackage, globals_, locals_, [modulename])
-            modict = module.__dict__
-            names = (modict['__all__'] if '__all__' in modict else
-                     [name for name in modict if name[0] != '_'])  # all public
-            exports.extend(names)
-            globals_.update((name, modict[name]) for name in names)
-
-    return exports
-
-if __name__ != '__main__':
-    __all__ = ['__all__'] + _import_package_files()  # '__all__' in __all__
+    for spec in get_specs():
+        spec.register_args(parser)
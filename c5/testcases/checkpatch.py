@@ -5,19 +5,118 @@
 #pylint: disable=missing-class-docstring
 #pylint: disable=missing-module-docstring
 
+import re
+
 import b4
+import b4.ty
 
 import c5
-from c5.testcases import TestCase, register_testcase, TestPass, TestWarning
+import c5.cache
+from c5.testcases import TestCase, TestPass, TestWarning
 
 logger = c5.logger
 
-@register_testcase(priority=100)
 class CheckPatchTestCase(TestCase):
 
     desc = "Run checkpatch.pl"
+    cost = 1
+
+    # commit -> result from the checkpatch run on the whole series
+    _series_results = {}
+
+    _ansi = re.compile(r"\x1b\[[0-9;]*m")
+    _header = re.compile(r"^Commit (?P<commit>[0-9a-f]+) \(")
+    _report = re.compile(r": (?:ERROR|WARNING|CHECK):")
+
+    def cache_key(self, parent_tree):
+        # The patch-id doesn't cover the commit message, checkpatch does
+        if self.info is not None:
+            message = self.info.message
+        else:
+            _, message = b4.ty.git_get_commit_message(None, self.commit)
+        return c5.cache.make_key(super().cache_key(parent_tree), message)
+
+    @classmethod
+    def split_series(cls, output, commits):
+        """Split the output of checkpatch on a range into the terse messages of each commit.
+           The reports are separated by empty lines, the first line of each is what
+           --terse would print. Headers only separate the commits when there are many.
+        """
+        messages = { commit: [] for commit in commits }
+        current = commits[0] if len(commits) == 1 else None
+        report = False
+
+        for line in output.splitlines(keepends=True):
+            plain = cls._ansi.sub("", line)
+            match = cls._header.match(plain)
+            if match is not None:
+                current = next(commit for commit in commits if commit.startswith(match.group("commit")))
+                continue
+
+            # Empty lines end the reports, dashes surround the headers
+            if plain.strip("-\n") == "":
+                report = False
+                continue
+
+            if not report and current is not None and cls._report.search(plain):
+                messages[current].append(line)
+            report = True
+
+        return { commit: TestWarning("".join(lines)[:-1]) if lines else TestPass("")
+                 for commit, lines in messages.items() }
+
+    @classmethod
+    def series_prep(cls, base_commit, series, cmdargs):
+        """Check all the commits in one checkpatch run, it needs no build"""
+        if vars(cmdargs).get("checkpatch_skip"):
+            return
+
+        commits = [ info.commit for info in series.commits ]
+        if len(commits) == 0:
+            return
+
+        if c5.cache.enabled:
+            cached = {}
+            for info in series.commits:
+                key = cls(info.commit, cmdargs, info).cache_key(info.parent_tree)
+                found = c5.cache.get_result(key)
+                if found is None:
+                    break
+                cached[info.commit] = found[0]
+
+            if len(cached) == len(commits):
+                cls._series_results = cached
+                return
+
+        kernel_base = b4.git_get_toplevel()
+        if kernel_base is None:
+            raise RuntimeError()
+
+        # --terse hides the commit headers, take the first line of each report instead
+        checkpatchargs = ["./scripts/checkpatch.pl", "--git", f"{base_commit}..{commits[-1]}",
+                          "--emacs", "--showfile", "--no-summary"]
+        if c5.color:
+            checkpatchargs.append("--color=always")
+        ecode, out, _ = c5.run_command(checkpatchargs, cwd=kernel_base)
+        if ecode not in (0, 1):
+            logger.debug("Checkpatch failed on the series, checking the commits one by one")
+            return
+
+        cls._series_results = cls.split_series(out.decode(), commits)
+
+    @classmethod
+    def series_result(cls, commit):
+        return cls._series_results.get(commit)
 
     def run(self):
+        result = self._series_results.get(self.commit)
+        if result is not None:
+            if isinstance(result, TestWarning):
+                logger.info("Checkpatch found something...")
+            if result.msg:
+                logger.info("%s", result.msg)
+            return result
+
         kernel_base = b4.git_get_toplevel()
         if kernel_base is None:
             raise RuntimeError()
@@ -25,17 +124,17 @@ class CheckPatchTestCase(TestCase):
         checkpatchargs = ["./scripts/checkpatch.pl", "--git", "HEAD", "--terse", "--showfile", "--no-summary"]
         if c5.color:
             checkpatchargs.append("--color=always")
-        ecode, out, err = c5.run_command(checkpatchargs, rundir=kernel_base)
+        ecode, out, err = c5.run_command(checkpatchargs, cwd=kernel_base)
 
         message = out.decode()
 
         if ecode == 0:
             if len(message) > 0:
                 logger.info("%s", message[:-1])
-            return TestPass()
+            return TestPass(message[:-1])
         elif ecode == 1:
             logger.info("Checkpatch found something...")
             logger.info("%s", message[:-1])
-            return TestWarning()
+            return TestWarning(message[:-1])
         else:
             raise RuntimeError()
@@ -12,62 +12,90 @@ import re
 import b4
 
 import c5
-from c5.testcases import TestCase, register_testcase
+import c5.kconfig
+from c5.testcases import TestCase, TestPass, TestWarning, TestFail
 logger = c5.logger
 
-@register_testcase(priority=700)
 class CompileTestCase(TestCase):
 
     desc = "Compile changed C source files"
+    uses_builddir = True
+    cpus = None
+    cost = 10
+    tools = ["{CROSS_COMPILE}gcc", "make"]
 
     def _applies(self):
-        files = c5.git_get_changed_files(self.commit)
+        files = self.changed_files()
         for file in files:
             if ".c" in file:
                 return True
 
         return False
 
-    def check_c_src(self, filename, pre=""):
-        makeargs = [ filename.replace(".c", ".o") ]
-        ecode, _, err = c5.linux_make(makeargs)
-        msg = err.decode()[:-1]
+    # gcc prefixes the messages with the file, or the file that included the header
+    file_pattern = re.compile(r"^(?:In file included from |\s+from )?(?P<file>[^\s:,]+)[:,]")
+
+    def check_c_src(self, filenames, arch, pre=""):
+        """Build all the objects in one make call, return the warnings per file.
+           If the build fails, the errors are saved in self.failures instead.
+        """
+        makeargs = [ filename.replace(".c", ".o") for filename in filenames ]
+        logname = c5.linux_logfile(f"{self.commit[:4]}-{arch}-compile{pre}")
+        ecode, _, err = c5.linux_make(makeargs, arch, logname=logname)
+        msg = err[:-1]
+        self.save_log(logname, arch, pre)
 
         if ecode != 0:
-            logger.error(f"Failed to {pre}build!")
+            logger.error(f"Failed to {pre}build for {arch}!")
             logger.info("%s", msg)
-            raise RuntimeError()
+            self.failures[arch] = msg
+            return {}
+
+        return c5.split_by_file(msg, filenames, self.file_pattern)
 
-        logname = c5.linux_logfile(f"{self.commit[:4]}-compile{pre}")
-        with open(logname, "w") as logfile:
-            logfile.write(msg)
-            logger.debug("Build warnings saved in %s", logname)
+    def check_arch(self, arch, files):
+        """Build the files that belong to the arch, return the warnings per file"""
+        # Files of other arches can't be built here
+        files = [ file for file in files if c5.arch_of(file) in (None, arch) ]
+        if len(files) == 0:
+            return {}
 
-        return msg
+        c5.kconfig.configure(arch)
+        return self.check_c_src(files, arch)
 
     def run(self):
-        ecode, _, err = c5.linux_make(["allyesconfig"])
-        assert ecode == 0
-
         files = []
-        for file in c5.git_get_changed_files(self.commit):
+        for file in self.changed_files():
             if not os.path.exists(file):
                 continue
             if ".c" in file:
                 files.append(file)
 
         if len(files) == 0:
-            return
+            return TestPass()
 
         notified = False
-
-        for file in files:
-            errs = self.check_c_src(file)
-            if len(errs) > 0:
-                self.pre_err += errs
-                if not notified:
-                    logger.info("Compile check resulted in warnings!")
-                    notified = True
-
-                logger.info("%s", errs)
-
+        warnings = []
+
+        self.failures = {}
+        arches = self.arches()
+        results = c5.for_each_arch(lambda arch: self.check_arch(arch, files), arches)
+        if len(self.failures) > 0:
+            return TestFail("\n".join(self.failures[arch] for arch in arches if arch in self.failures))
+        for arch, errs in zip(arches, results):
+            for file in [None] + files:
+                if len(errs.get(file, "")) > 0:
+                    if not notified:
+                        logger.info("Compile check resulted in warnings!")
+                        notified = True
+
+                    if len(arches) > 1 and notified != arch:
+                        logger.info("On %s:", arch)
+                        notified = arch
+                    logger.info("%s", errs[file].rstrip("\n"))
+                    warnings.append(errs[file].rstrip("\n"))
+
+        if len(warnings) > 0:
+            return TestWarning("\n".join(warnings))
+
+        return TestPass()
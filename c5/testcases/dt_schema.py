@@ -7,42 +7,71 @@
 #pylint: disable=attribute-defined-outside-init
 
 import os
+import re
 
 import c5
-from c5.testcases import TestCase, register_testcase, TestPass, TestWarning
+import c5.cache
+from c5.testcases import TestCase, TestPass, TestWarning
 
 logger = c5.logger
 
-@register_testcase(priority=500)
 class DtSchemaTestCase(TestCase):
 
     desc = "Run dt_binding_check on changed files"
+    uses_builddir = True
+    cpus = None
+    cost = 50
+    tools = ["make", "dt-doc-validate"]
 
     def _applies(self):
-        files = c5.git_get_changed_files(self.commit)
+        files = self.changed_files()
         for file in files:
             if "Documentation/devicetree/bindings/" in file:
                 return True
 
         return False
 
-    def check_yaml(self, filename, pre=""):
-        makeargs = ["dt_binding_check", f"DT_SCHEMA_FILES=\"{filename}\""]
-        ecode, _, err = c5.linux_make(makeargs)
-
-        msg = err.decode()[:-1]
+    # Messages name the schema or its example, e.g. foo/bar.yaml or foo/bar.example.dtb
+    file_pattern = re.compile(r"Documentation/devicetree/bindings/(?P<file>[^\s:]+?)(?:\.example)?\.(?:yaml|dts|dtb)\b")
 
+    def check_yaml(self, filenames, pre="", consumer=None):
+        """Check the schemas in one make call, return the warnings unless a consumer
+           is given to process them.
+        """
+        makeargs = ["dt_binding_check", f"DT_SCHEMA_FILES=\"{':'.join(filenames)}\""]
+        logname = c5.linux_logfile(f"{self.commit[:4]}-dtschema{pre}")
+        ecode, _, err = c5.linux_make(makeargs, consumer=consumer, logname=logname)
         if ecode != 0:
             logger.error("Failed to {pre}build!")
-            logger.info("%s", msg)
+            with open(logname, "r") as logfile:
+                logger.info("%s", logfile.read()[:-1])
+            self.save_log(logname, pre)
             raise RuntimeError()
 
-        logname = c5.linux_logfile(f"{self.commit[:4]}-dtschema{pre}")
-        with open(logname, "w") as logfile:
-            logfile.write(msg)
-            logger.debug("Build warnings saved in %s", logname)
+        self.save_log(logname, pre)
+
+        if err is None:
+            return None
+
+        return err[:-1]
+
+    def check_yaml_baseline(self, filenames, pre):
+        """Check the schemas on the current tree, reusing the warnings from a previous run"""
+        key = self.baseline_key(c5.git_get_tree(), sorted(filenames))
+        errs = c5.cache.get_baseline(key)
+        if errs is not None:
+            logger.debug("Reusing the schema baseline")
+            return errs
 
-        return msg
+        errs = self.check_yaml(filenames, pre=pre)
+        c5.cache.put_baseline(key, errs)
+        return errs
+
+    def split_by_schema(self, msg, filenames):
+        """Split the warnings into the ones about each schema"""
+        stems = { filename.replace(".yaml", ""): filename for filename in filenames }
+        parts = c5.split_by_file(msg, stems, self.file_pattern)
+        return [ (stems.get(stem), text.rstrip("\n")) for stem, text in parts.items() ]
 
     def prep(self):
         """
@@ -52,7 +81,7 @@ class DtSchemaTestCase(TestCase):
 
 
         files = []
-        for file in c5.git_get_changed_files(self.commit):
+        for file in self.changed_files():
             if not os.path.exists(file):
                 continue
             if ".yaml" in file:
@@ -61,12 +90,12 @@ class DtSchemaTestCase(TestCase):
         if len(files) == 0:
             return
 
+        self.pre_err = self.check_yaml_baseline(files, pre="pre-")
+
         notified = False
 
-        for file in files:
-            errs = self.check_yaml(file, pre="pre-")
+        for _, errs in self.split_by_schema(self.pre_err, files):
             if len(errs) > 0:
-                self.pre_err += errs
                 if not notified:
                     logger.info("YAML pre-check resulted in warnings!")
                     notified = True
@@ -76,20 +105,28 @@ class DtSchemaTestCase(TestCase):
 
     def run(self):
         files = []
-        for file in c5.git_get_changed_files(self.commit):
+        for file in self.changed_files():
             if ".yaml" in file:
                 files.append(file.replace("Documentation/devicetree/bindings/", ""))
 
         assert len(files) > 0
 
+        newlines = c5.NewLines(self.pre_err)
+        self.check_yaml(files, consumer=newlines)
+
         notified = False
+        warnings = []
 
-        for file in files:
-            errs = self.check_yaml(file)
-            errs = c5.get_new_lines(self.pre_err, errs)
+        for _, errs in self.split_by_schema(newlines.text(), files):
             if len(errs) > 0:
                 if not notified:
                     logger.info("YAML check resulted in new warnings!")
                     notified = True
 
                 logger.info("%s", errs)
+                warnings.append(errs)
+
+        if len(warnings) > 0:
+            return TestWarning("\n".join(warnings))
+
+        return TestPass()
@@ -12,114 +12,140 @@ import re
 import b4
 
 import c5
-from c5.testcases import TestCase, register_testcase, TestPass, TestWarning
+import c5.cache
+import c5.dts
+import c5.kconfig
+from c5.testcases import TestCase, TestPass, TestWarning
 
 logger = c5.logger
 
-@register_testcase(priority=700)
 class DtbsTestCase(TestCase):
 
     desc = "Run dtbs_check on changed files"
-
-    @classmethod
-    def _register_args(cls, parser):
-        """Register testcase cmdline args."""
-        cls.add_arg(parser, "filter", action="store", help=f"Filter to use when looking up which dtb files to check.")
+    uses_builddir = True
+    cpus = None
+    mutates_tree = True
+    cost = 100
+    tools = ["{CROSS_COMPILE}gcc", "make", "dt-validate"]
 
     def _applies(self):
-        files = c5.git_get_changed_files(self.commit)
+        files = self.changed_files()
         for file in files:
             if ".dts" in file:
                 return True
 
         return False
 
-    def check_dtbs(self, filenames, pre=""):
-        makeargs = ["CHECK_DTBS=y", "W=1"] + filenames
-        ecode, _, err = c5.linux_make(makeargs)
+    def arches(self):
+        """Return the arches of the changed dts files"""
+        arches = set(c5.arch_of(file) for file in self.changed_files() if ".dts" in file) - {None}
+        if c5.arches:
+            arches &= set(c5.arches)
 
-        msg = err.decode()[:-1]
+        return sorted(arches)
 
+    def check_dtbs(self, filenames, arch, pre="", consumer=None):
+        """Check the dtbs, return the warnings unless a consumer is given to process them"""
+        makeargs = ["CHECK_DTBS=y", "W=1"] + filenames
+        logname = c5.linux_logfile(f"{self.commit[:4]}-{arch}-dtbs{pre}")
+        ecode, _, err = c5.linux_make(makeargs, arch, consumer=consumer, logname=logname)
         if ecode != 0:
-            logger.error("Failed to build {pre}!")
-            logger.info("%s", msg)
+            logger.error(f"Failed to build {pre} for {arch}!")
+            with open(logname, "r") as logfile:
+                logger.info("%s", logfile.read()[:-1])
+            self.save_log(logname, arch, pre)
             raise RuntimeError()
 
-        logname = c5.linux_logfile(f"{self.commit[:4]}-dtbs{pre}")
-        with open(logname, "w") as logfile:
-            logfile.write(msg)
-            logger.debug("Build warnings saved in %s", logname)
+        self.save_log(logname, arch, pre)
+
+        if err is None:
+            return None
+
+        return err[:-1]
+
+    def check_dtbs_baseline(self, filenames, arch, pre, tree, changed=()):
+        """Check the dtbs, reusing the warnings from a previous run on the same tree and config.
+           changed lists the files that were modified on top of the tree.
+        """
+        key = self.baseline_key(tree, arch, c5.linux_config_id(arch), sorted(filenames), list(changed))
+        errs = c5.cache.get_baseline(key)
+        if errs is not None:
+            logger.debug("Reusing the %s baseline for %s", pre, arch)
+            return errs
 
-        return msg
+        errs = self.check_dtbs(filenames, arch, pre)
+        c5.cache.put_baseline(key, errs)
+        return errs
 
     def target_list(self):
-        files = c5.git_get_changed_files(self.commit)
+        """Return the dtbs of each arch built from the changed files, directly or through includes"""
+        return { arch: self.arch_target_list(arch) for arch in self.arches() }
 
-        arches = []
-        vendors = []
+    def arch_target_list(self, arch):
+        """Return the dtbs of the arch built from the changed files"""
+        files = self.changed_files()
 
         pat = re.compile(r"arch/(?P<arch>\w+)/boot/dts/(?P<vendor>\w+)/(?P<source>[\w-]+\.dtsi?)")
 
-        for file in files:
-            if ".dts" not in file:
-                continue
+        kernel_base = b4.git_get_toplevel()
+        graph = c5.dts.IncludeGraph(kernel_base, arch)
+        sources = graph.dts_using(file for file in files if os.path.exists(file))
 
-            match = pat.search(file)
-            arches.append(match.group("arch"))
-            vendors.append(match.group("vendor"))
+        vendors = set()
+        for source in sources:
+            match = pat.search(source)
+            if match is None or match.group("arch") != arch:
+                continue
 
-        if len(set(arches)) != 1:
-            print(f"{arches=}")
-            raise NotImplementedError()
+            vendors.add(match.group("vendor"))
 
-        kernel_base = b4.git_get_toplevel()
         targets = []
 
         pattern = self.get_arg("filter")
-        if pattern is None:
+        if not pattern: # Unset options default to False
             pattern = ""
 
-        pat = re.compile(r"(?P<target>" + pattern + r"[\w-]+\.dtb)")
+        pat = re.compile(pattern + r"[\w-]+\.dtb")
 
         for vendor in vendors:
-            makefile = f"{kernel_base}/arch/{arches[0]}/boot/dts/{vendor}/Makefile"
-            if not os.path.exists(makefile):
+            index = c5.dts.dtb_index(kernel_base, f"arch/{arch}/boot/dts/{vendor}")
+            if index is None:
                 raise RuntimeError()
 
-            lines = []
-            with open(makefile, "r") as file:
-                lines = file.read().splitlines()
-
-            for line in lines:
-                match = pat.search(line)
-                if match is None:
+            for target, entry in index.items():
+                if pat.fullmatch(target) is None:
                     continue
-
-                target = match.group("target")
-                if target is None:
+                if not any(source in sources for source in entry["sources"]):
                     continue
 
-                if arches[0] != "arm":
+                if arch != "arm":
                     target = f"{vendor}/{target}"
 
                 targets.append(target)
 
-        return list(set(targets))
+        return targets
 
+    def prep_arch(self, arch, targets, tree):
+        c5.kconfig.configure(arch)
+
+        logger.debug("We have %d dtbs to pre-check for %s...", len(targets), arch)
+        if len(targets) == 0:
+            return ""
+
+        return self.check_dtbs_baseline(targets, arch, "pre", tree)
 
     def prep(self):
-        ecode, _, err = c5.linux_make(["allyesconfig"])
-        assert ecode == 0
+        self.targets = self.target_list()
+        arches = list(self.targets)
+        tree = c5.git_get_tree()
 
-        targets = self.target_list()
-        logger.debug("We have %d dtbs to pre-check...", len(targets))
         # they will always have warnings, save but print nothing...
-        self.pre_err =  ""
-        if len(targets) > 0:
-            self.pre_err = self.check_dtbs(targets, pre="pre")
+        errs = c5.for_each_arch(lambda arch: self.prep_arch(arch, self.targets[arch], tree), arches)
+        self.pre_err = dict(zip(arches, errs))
 
     def undisable_all(self):
-        changed_files = c5.git_get_changed_files(self.commit)
+        self.undisabled = []
+        changed_files = self.changed_files()
         for file in changed_files:
             if ".dts" not in file:
                 continue
@@ -128,14 +154,30 @@ class DtbsTestCase(TestCase):
             sedargs = ["sed", "-i", "/status.*\(disabled\|reserved\)/d", file]
             ecode, _, _ = c5.run_command(sedargs)
             assert ecode == 0
+            self.undisabled.append(file)
+
+    def check_new(self, arch, old_errs, pre=""):
+        """Check the dtbs of the arch, return the warnings not in old_errs"""
+        if len(self.targets[arch]) == 0:
+            return ""
+
+        newlines = c5.NewLines(old_errs)
+        self.check_dtbs(self.targets[arch], arch, pre, consumer=newlines)
+        return newlines.text()
 
     def run(self):
-        targets = self.target_list()
-        errs = self.check_dtbs(targets)
-        errs = c5.get_new_lines(self.pre_err, errs)
-        if len(errs) > 0:
-            logger.info("DTB check resulted in new warnings!")
-            logger.info("%s", errs)
+        # The commit may have added dts files
+        self.targets = self.target_list()
+        arches = [ arch for arch, targets in self.targets.items() if len(targets) > 0 ]
+        if len(arches) == 0:
+            return TestPass()
+
+        warnings = []
+        for errs in c5.for_each_arch(lambda arch: self.check_new(arch, self.pre_err.get(arch, "")), arches):
+            if len(errs) > 0:
+                logger.info("DTB check resulted in new warnings!")
+                logger.info("%s", errs)
+                warnings.append(errs)
 
         # The checker ignores disabled nodes. Remove status=disabled from changed files and run again.
 
@@ -149,20 +191,27 @@ class DtbsTestCase(TestCase):
 
         self.undisable_all()
 
-        old_errs = self.check_dtbs(targets, "enall-pre")
+        parent_tree = c5.git_get_tree("HEAD^")
+        old_errs = c5.for_each_arch(lambda arch: self.check_dtbs_baseline(
+            self.targets[arch], arch, "enall-pre", parent_tree, self.undisabled), arches)
 
         gitargs = ["checkout", "."]
         ecode, _ = b4.git_run_command(None, gitargs)
         assert ecode == 0
         self.undisable_all()
 
-        new_errs = self.check_dtbs(targets, "enall")
-
-        errs = c5.get_new_lines(old_errs, new_errs)
-        if len(errs) > 0:
-            logger.info("DTB check without disables resulted in new warnings!")
-            logger.info("%s", errs)
+        old_errs = dict(zip(arches, old_errs))
+        for errs in c5.for_each_arch(lambda arch: self.check_new(arch, old_errs[arch], "enall"), arches):
+            if len(errs) > 0:
+                logger.info("DTB check without disables resulted in new warnings!")
+                logger.info("%s", errs)
+                warnings.append(errs)
 
         gitargs = ["checkout", "."]
         ecode, _ = b4.git_run_command(None, gitargs)
         assert ecode == 0
+
+        if len(warnings) > 0:
+            return TestWarning("\n".join(warnings))
+
+        return TestPass()
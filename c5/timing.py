@@ -0,0 +1,76 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2023 Nikita Travkin <nikita@trvn.ru>
+
+#pylint: disable=missing-module-docstring
+
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+# Finished spans, in the Chrome trace event format
+events = []
+
+# The commit being tested, spans are attributed to it
+commit = None
+
+def _child_usage():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss
+
+def add(name, cat, start, duration, **args):
+    """Record a span that started at start (time.time()) and lasted duration seconds"""
+    args["commit"] = commit
+    events.append({
+        "name": name,
+        "cat": cat,
+        "ph": "X",
+        "ts": int(start * 1000000),
+        "dur": int(duration * 1000000),
+        "pid": os.getpid(),
+        "tid": threading.get_ident(),
+        "args": args,
+    })
+
+@contextmanager
+def span(name, cat):
+    """Record the wall time, the CPU time of the child processes and their max RSS.
+       Child usage is process-wide, spans that overlap in other threads add to it.
+    """
+    start = time.time()
+    startclock = time.perf_counter()
+    startcpu, _ = _child_usage()
+    try:
+        yield
+    finally:
+        cpu, maxrss = _child_usage()
+        add(name, cat, start, time.perf_counter() - startclock, cpu=cpu - startcpu, maxrss=maxrss)
+
+def summary(of_commit):
+    """Return a table of the time spent on the commit"""
+    rows = {}
+    for event in events:
+        if event["args"]["commit"] != of_commit:
+            continue
+
+        row = rows.setdefault((event["cat"], event["name"]), [0, 0, 0, 0])
+        row[0] += 1
+        row[1] += event["dur"] / 1000000
+        row[2] += event["args"].get("cpu", 0)
+        row[3] = max(row[3], event["args"].get("maxrss", 0))
+
+    lines = [f"{'':<60} {'count':>6} {'wall s':>9} {'cpu s':>9} {'rss MiB':>8}"]
+    for (cat, name), (count, wall, cpu, maxrss) in sorted(rows.items(), key=lambda row: -row[1][1]):
+        label = f"{cat}: {name}"
+        if len(label) > 60:
+            label = label[:57] + "..."
+        lines.append(f"{label:<60} {count:>6} {wall:>9.2f} {cpu:>9.2f} {maxrss // 1024:>8}")
+
+    return "\n".join(lines)
+
+def write_trace(filename):
+    """Write all the spans as a Chrome trace (chrome://tracing, ui.perfetto.dev)"""
+    with open(filename, "w") as file:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
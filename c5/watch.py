@@ -0,0 +1,147 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2023 Nikita Travkin <nikita@trvn.ru>
+
+#pylint: disable=missing-module-docstring
+
+import hashlib
+import os
+import time
+import traceback
+
+import b4
+
+import c5
+import c5.ccache
+import c5.test
+import c5.testcases
+import c5.timing
+
+logger = c5.logger
+
+def git_current_branch():
+    """Return the full ref name of the checked out branch"""
+    lines = b4.git_get_command_lines(None, ["symbolic-ref", "--quiet", "HEAD"])
+    if not lines:
+        logger.error("Not on a branch. Checkout the branch to watch.")
+        raise RuntimeError()
+
+    return lines[0]
+
+def git_is_ancestor(commit, descendant):
+    ecode, _ = b4.git_run_command(None, ["merge-base", "--is-ancestor", commit, descendant])
+    return ecode == 0
+
+def identity(info):
+    """Return what tells if the commit changed, the patch-id doesn't cover the message"""
+    return (info.patch_id, hashlib.sha256(info.message.encode()).hexdigest())
+
+def first_changed(series, tested):
+    """Return the index of the first commit of the series that was not tested yet.
+       tested lists the identity() of the commits tested before, in order.
+    """
+    first = 0
+    for info, done in zip(series.commits, tested):
+        if identity(info) != done:
+            break
+        first += 1
+
+    return first
+
+def test_changes(series, tested, cmdargs):
+    """Test the commits from the first changed one to the end of the series.
+       Return the identity() of the commits tested so far and the commits with a TestFail.
+    """
+    commits = [ info.commit for info in series.commits ]
+    patch_ids = [ identity(info) for info in series.commits ]
+
+    first = first_changed(series, tested)
+    if first == len(commits):
+        logger.info("No changed commits to test")
+        return patch_ids, []
+
+    logger.info("Will test %d of %d commits, starting at '%s' %s",
+                len(commits) - first, len(commits), commits[first][:12], series.commits[first].subject)
+
+    parent = commits[first - 1] if first > 0 else series.base
+    passes = c5.test.plan(cmdargs)
+    ccache_stats = c5.ccache.stats()
+    try:
+        for testcase in c5.testcases.get_testcases(cmdargs):
+            testcase.series_prep(series.base, series, cmdargs)
+
+        c5.test.git_checkout(parent, force=True)
+        for phase, testcases in enumerate(passes):
+            failed = c5.test.test_commits(parent, commits[first:], cmdargs, series, testcases)
+            if cmdargs.fail_fast and len(failed) > 0:
+                logger.error("Stopping at the failure in '%s'", failed[-1][:12])
+                skipped = [ (commit, testcases) for commit in c5.test.commits_after(commits, failed[-1]) ]
+                skipped += [ (commit, later) for later in passes[phase + 1:] for commit in commits[first:] ]
+                c5.test.report_skipped(skipped, cmdargs, series)
+            if len(failed) > 0:
+                # Test them again next time, even if they don't change
+                return patch_ids[:commits.index(failed[0])], failed
+    except Exception: # Keep watching
+        logger.debug("%s", traceback.format_exc())
+        logger.error("Testing failed, will try again when the branch changes")
+        return tested, []
+    finally:
+        c5.ccache.report(ccache_stats)
+
+    logger.info("Done!")
+    return patch_ids, []
+
+def main(cmdargs):
+    """Test the series whenever the branch changes, in a worktree of its own"""
+    c5.test.configure(cmdargs)
+
+    ref = git_current_branch()
+    base_commit = c5.test.find_base(cmdargs)
+
+    # The sources and the build dir stay warm between the changes
+    home = os.getcwd()
+    out_base = c5.linux_out_base()
+    worktree = f"{out_base}worktrees/watch"
+    c5.test.git_worktree_add(worktree, base_commit)
+    os.chdir(worktree)
+    c5.builddir = f"{out_base}build-watch/"
+
+    logger.info("Watching %s, press Ctrl-C to stop", ref)
+
+    tip = None
+    tested = []
+    try:
+        while True:
+            new_tip = c5.test.git_rev_parse(ref)
+            if new_tip == tip:
+                time.sleep(cmdargs.interval)
+                continue
+
+            tip = new_tip
+
+            # The --base may be a ref, and b4 looks at the branch, both in the main checkout
+            os.chdir(home)
+            if cmdargs.base or not git_is_ancestor(base_commit, tip):
+                new_base = c5.test.find_base(cmdargs)
+            else:
+                new_base = base_commit
+            os.chdir(worktree)
+
+            if new_base != base_commit:
+                logger.info("The base moved to '%s', testing all the commits", new_base[:12])
+                base_commit = new_base
+                tested = []
+
+            if not cmdargs.trace:
+                c5.timing.events.clear()
+
+            series = c5.SeriesIndex(base_commit, tip)
+            tested, failed = test_changes(series, tested, cmdargs)
+            if len(failed) > 0:
+                logger.error("Failed: %s", ", ".join(f"'{commit[:12]}' {series[commit].subject}" for commit in failed))
+            logger.info("Waiting for changes to %s", ref)
+    except KeyboardInterrupt:
+        logger.info("Stopped watching")
+    finally:
+        if cmdargs.trace:
+            c5.timing.write_trace(cmdargs.trace)
+            logger.info("Trace saved in %s", cmdargs.trace)
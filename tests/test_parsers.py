@@ -0,0 +1,31 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2023 Nikita Travkin <nikita@trvn.ru>
+
+#pylint: disable=missing-module-docstring
+#pylint: disable=missing-function-docstring
+
+import c5
+
+DUPLICATE = ("arch/arm64/boot/dts/vendor/board.dts:{}: ERROR (duplicate_node_names): /soc/foo@1: Duplicate node name\n"
+             "  also defined at arch/arm64/boot/dts/vendor/board.dts:{}\n")
+
+def new_lines(old, new):
+    newlines = c5.NewLines(old)
+    for line in new.splitlines(keepends=True):
+        newlines(line, True)
+
+    return newlines.text()
+
+def test_shifted_positions():
+    old = DUPLICATE.format("50.9-55.3", "40.8-45.3")
+    new = DUPLICATE.format("52.9-57.3", "42.8-47.3")
+
+    assert c5.get_new_lines(old, new) == ""
+    assert new_lines(old, new) == ""
+
+def test_other_position_file():
+    old = DUPLICATE.format("50.9-55.3", "40.8-45.3")
+    new = old.replace("defined at arch/arm64/boot/dts/vendor/board.dts", "defined at arch/arm64/boot/dts/vendor/soc.dtsi")
+
+    assert c5.get_new_lines(old, new) == new
+    assert new_lines(old, new) == new.rstrip("\n")
@@ -0,0 +1,36 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2023 Nikita Travkin <nikita@trvn.ru>
+
+#pylint: disable=missing-module-docstring
+#pylint: disable=missing-function-docstring
+
+import threading
+
+import c5
+
+def test_consumer_raises():
+    """The command is stopped instead of blocking on the full pipe"""
+    def consumer(line, is_err):
+        raise ValueError(line)
+
+    errors = []
+    def run():
+        try:
+            c5.run_command_stream(["sh", "-c", "seq 1 200000 >&2"], consumer)
+        except ValueError as error:
+            errors.append(error)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout=30)
+
+    assert not thread.is_alive()
+    assert len(errors) == 1
+
+def test_consumer_gets_all_lines():
+    got = []
+    ecode = c5.run_command_stream(["sh", "-c", "seq 1 3; seq 4 5 >&2"], lambda line, is_err: got.append((line, is_err)))
+
+    assert ecode == 0
+    assert [ line for line, is_err in got if not is_err ] == ["1\n", "2\n", "3\n"]
+    assert [ line for line, is_err in got if is_err ] == ["4\n", "5\n"]